@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from telebot.async_telebot import AsyncTeleBot
+import logger
+
+
+class AsyncRuntime:
+    """Serves the handlers of a handlers.Handlers registry with pyTelegramBotAPI's AsyncTeleBot.
+
+    Bot API calls are awaited on the event loop over a pooled keep-alive HTTP session, so a single
+    process answers many inline queries at once. Blocking handlers, those waiting on the database
+    or on files, run on a pool of worker threads, and the rest runs on the event loop.
+    """
+
+    def __init__(self, token, handlers, workers=8):
+        global LOG
+        LOG = logger.get_logger('asyncbot')
+        self.handlers = handlers
+        self.bot = AsyncTeleBot(token)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='async-handlers')
+        for route in handlers.routes:
+            getattr(self.bot, route.kind)(**route.filters)(self._handler(route))
+
+    def _handler(self, route):
+        duration = self.handlers.histogram.labels(route.name)
+        errors = self.handlers.errors.labels(route.name)
+
+        async def handle(update):
+            start = time.perf_counter()
+            try:
+                if route.blocking:
+                    calls = await asyncio.get_event_loop().run_in_executor(self.executor, route.build, update)
+                else:
+                    calls = route.build(update)
+                for call in calls or ():
+                    await getattr(self.bot, call.method)(*call.args, **call.kwargs)
+            except Exception as e:
+                errors.inc()
+                LOG.error('%s failed: %s', route.name, e)
+            finally:
+                duration.observe(time.perf_counter() - start)
+        return handle
+
+    async def process(self, update):
+        """Handles an update received by a webhook."""
+        await self.bot.process_new_updates([update])
+
+    async def close(self):
+        await self.bot.close_session()
+        self.executor.shutdown(wait=True)
+
+    def polling(self):
+        """Polls for updates until interrupted."""
+        async def poll():
+            try:
+                await self.bot.delete_webhook()
+                LOG.debug("Async polling started")
+                await self.bot.infinity_polling()
+            finally:
+                await self.close()
+        # asyncio.run() only exists since Python 3.7.
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(poll())
+        finally:
+            loop.close()
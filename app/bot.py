@@ -1,23 +1,44 @@
 import telebot
 import requests
-import string
-import telebot.types as types
 import argparse
 import json
-import unidecode
-import random
 from time import sleep
 from persistence import *
 import logger
 import os
 import PrettyUptime
 import webhook
+import metrics
+import media
+import static
+import supervisor
+import search
+import normalizer
+import paging
+import ranking
+from catalogue import Catalogue
+from watcher import FileWatcher
+from handlers import Handlers, reply
+import threading
+import atexit
+from persistence import writebehind
+from persistence import tuning as db_tuning
+from persistence.cache import RecentSoundsCache
+from persistence.stats import Stats
+from persistence.retention import Retention
+from persistence.debounce import QueryCoalescer
+import datetime
 
 BOT_NAME = 'QuakeSounds_Bot'
 logger.set_logger(BOT_NAME)
 LOG = logger.get_logger()
-REMOVE_CHARS = string.punctuation + string.whitespace
 TELEGRAM_INLINE_MAX_RESULTS = 48
+# Seconds Telegram caches each page of an answer. The first page of the empty query lists the last
+# sounds chosen by the user, so it is never cached. Other pages only change with the ranking.
+EMPTY_QUERY_CACHE_TIME = 0
+EMPTY_QUERY_PAGE_CACHE_TIME = 30
+TEXT_QUERY_CACHE_TIME = 5
+TEXT_QUERY_PAGE_CACHE_TIME = 60
 
 _ENV_TELEGRAM_BOT_TOKEN = "TELEGRAM_BOT_TOKEN"
 _ENV_TELEGRAM_USER_ALIAS = "TELEGRAM_USER_ALIAS"
@@ -33,6 +54,25 @@ _ENV_WEBHOOK_HOST = 'WEBHOOK_HOST'
 _ENV_WEBHOOK_PORT = 'WEBHOOK_PORT'
 _ENV_WEBHOOK_LISTEN = 'WEBHOOK_LISTEN'
 _ENV_WEBHOOK_LISTEN_PORT = 'WEBHOOK_LISTEN_PORT'
+_ENV_WEBHOOK_WORKERS = 'WEBHOOK_WORKERS'
+_ENV_WEBHOOK_PROCESSES = 'WEBHOOK_PROCESSES'
+_ENV_SEARCH_MODE = 'SEARCH_MODE'
+_ENV_SQLITE_JOURNAL_MODE = 'SQLITE_JOURNAL_MODE'
+_ENV_SQLITE_SYNCHRONOUS = 'SQLITE_SYNCHRONOUS'
+_ENV_SQLITE_MMAP_SIZE = 'SQLITE_MMAP_SIZE'
+_ENV_DB_CONNECT_TIMEOUT = 'DB_CONNECT_TIMEOUT'
+_ENV_RETENTION_DAYS = 'RETENTION_DAYS'
+_ENV_QUERY_IDLE_WINDOW = 'QUERY_IDLE_WINDOW'
+_ENV_METRICS_PORT = 'METRICS_PORT'
+_ENV_LOG_SAMPLE_EVERY = 'LOG_SAMPLE_EVERY'
+_ENV_ASYNC_MODE = 'ASYNC_MODE'
+_ENV_SOUNDS_DIR = 'SOUNDS_DIR'
+_ENV_MEDIA_CHAT = 'MEDIA_CHAT'
+_ENV_SERVE_SOUNDS = 'SERVE_SOUNDS'
+_ENV_SOUNDS_HOST = 'SOUNDS_HOST'
+_ENV_SOUNDS_PORT = 'SOUNDS_PORT'
+_ENV_RANKING_HALF_LIFE = 'RANKING_HALF_LIFE'
+_ENV_RANKING_INTERVAL = 'RANKING_INTERVAL'
 
 
 parser = argparse.ArgumentParser()
@@ -46,6 +86,17 @@ parser.add_argument("--mysql-host", type=str, help="mysql host")
 parser.add_argument("--mysql-port", type=str, help="mysql port", default='3306')
 parser.add_argument("--mysql-user", type=str, help="mysql user")
 parser.add_argument("--mysql-password", type=str, help="mysql password")
+parser.add_argument("--sqlite-journal-mode", type=str, help="SQLite journal mode. Default is WAL",
+                    choices=db_tuning.JOURNAL_MODES, default=db_tuning.DEFAULT_TUNING.sqlite_journal_mode)
+parser.add_argument("--sqlite-synchronous", type=str, help="SQLite synchronous mode. Default is NORMAL",
+                    choices=db_tuning.SYNCHRONOUS_MODES, default=db_tuning.DEFAULT_TUNING.sqlite_synchronous)
+parser.add_argument("--sqlite-mmap-size", type=int, help="Bytes of the SQLite file mapped in memory. Default is 256MiB",
+                    default=db_tuning.DEFAULT_TUNING.sqlite_mmap_size)
+parser.add_argument("--db-connect-timeout", type=int, help="Seconds to wait for a database connection or lock. "
+                                                           "MySQL and PostgreSQL connections are kept open per "
+                                                           "thread, but their statements are not prepared on the "
+                                                           "server. Default is 10",
+                    default=db_tuning.DEFAULT_TUNING.connect_timeout)
 parser.add_argument("--token", type=str, help="Telegram API token given by @botfather.")
 parser.add_argument("--admin", type=str, help="Alias of the admin user.")
 parser.add_argument("--data", type=str, help="Data JSON path.", default='data.json')
@@ -55,6 +106,75 @@ parser.add_argument("--webhook-port", type=int, help="Webhook port. Default is 4
 parser.add_argument("--webhook-listening", type=str, help="Webhook local listening IP. Default is 0.0.0.0",
                     default="0.0.0.0")
 parser.add_argument("--webhook-listening-port", type=int, help="Webhook local listening port. Default is 8080", default=8080)
+parser.add_argument("--webhook-workers", type=int, help="Webhook updates processed concurrently. Default is 8", default=8)
+parser.add_argument("--webhook-processes", type=int, help="Worker processes serving the webhook, each with "
+                                                          "--webhook-workers workers. Default is 1", default=1)
+parser.add_argument("--search", type=str, help="Search mode. 'fuzzy' also matches queries with typos. Default is prefix",
+                    choices=search.MODES, default=search.MODE_PREFIX)
+parser.add_argument("--history-queue-size", type=int, help="Max pending history events. Default is 10000",
+                    default=10000)
+parser.add_argument("--history-batch-size", type=int, help="History events written per transaction. Default is 200",
+                    default=200)
+parser.add_argument("--history-flush-interval", type=float, help="Max seconds history events wait to be written. "
+                                                                 "Default is 1", default=1.0)
+parser.add_argument("--history-drop-policy", type=str, help="Events to drop when the history queue is full. "
+                                                            "Default is oldest",
+                    choices=writebehind.DROP_POLICIES, default=writebehind.DROP_OLDEST)
+parser.add_argument("--migration-chunk-size", type=int, help="Rows copied per transaction when migrating from SQLite "
+                                                              "to MySQL. Default is 1000", default=1000)
+parser.add_argument("--migration-checkpoint", type=str, help="File where migration progress is saved so that an "
+                                                             "interrupted migration resumes. Default is the SQLite "
+                                                             "file path followed by .migration")
+parser.add_argument("--data-watch-interval", type=float, help="Seconds between checks for data JSON changes. "
+                                                             "0 disables reloading on changes. Default is 5",
+                    default=5.0)
+parser.add_argument("--retention-days", type=int, help="Days of raw query and result history kept before it is rolled "
+                                                       "up into daily aggregates and purged. Default is 0, keep forever",
+                    default=0)
+parser.add_argument("--retention-interval", type=float, help="Hours between retention runs. Default is 24", default=24)
+parser.add_argument("--retention-archive-dir", type=str, help="Directory where purged history rows are archived.")
+parser.add_argument("--compact", action='store_true', help="Roll up and purge old history once and exit. Keeps "
+                                                       "--retention-days of raw history, or 30 if unset.")
+parser.add_argument("--recent-cache-size", type=int, help="Users whose recent sounds are kept in memory. "
+                                                          "Default is 10000", default=10000)
+parser.add_argument("--user-cache-size", type=int, help="Users whose profile is kept in memory to skip writing "
+                                                        "unchanged profiles. Default is 100000", default=100000)
+parser.add_argument("--user-cache-ttl", type=float, help="Seconds a cached user profile is trusted. Default is 3600",
+                    default=3600.0)
+parser.add_argument("--async", dest='async_mode', action='store_true',
+                    help="Serve updates from an asyncio event loop, with blocking handlers on --webhook-workers "
+                         "threads.")
+parser.add_argument("--log-sample-every", type=int, help="Only one of every N inline queries and chosen results is "
+                                                         "logged. Default is 100", default=100)
+parser.add_argument("--metrics-port", type=int, help="Port serving Prometheus metrics on /metrics. In webhook mode "
+                                                     "they are also served by the webhook. Default is 0, disabled",
+                    default=0)
+parser.add_argument("--query-idle-window", type=float, help="Seconds a user must stop typing before the last inline "
+                                                            "query is saved. 0 saves every query. Default is 2",
+                    default=2.0)
+parser.add_argument("--sounds-dir", type=str, help="Local directory with the sound files, uploaded to Telegram "
+                                                   "once so that results are sent by file_id.")
+parser.add_argument("--media-chat", type=str, help="Chat where sound files are uploaded. Required by --sounds-dir.")
+parser.add_argument("--media-upload", type=str, help="When sound files are uploaded. 'eager' uploads every sound on "
+                                                     "start and reload, 'lazy' a sound when it is first chosen. "
+                                                     "Default is eager",
+                    choices=media.UPLOAD_MODES, default=media.UPLOAD_EAGER)
+parser.add_argument("--serve-sounds", action='store_true', help="Serve the files of --sounds-dir from the webhook "
+                                                                "server, or from --sounds-port when polling, instead "
+                                                                "of linking to --bucket.")
+parser.add_argument("--sounds-host", type=str, help="Public host of the sound server when polling.")
+parser.add_argument("--sounds-port", type=int, help="Port of the sound server when polling. Default is 8081",
+                    default=8081)
+parser.add_argument("--first-page-size", type=int, help="Results in the first page of an inline answer, the next "
+                                                          "pages have %d. Default is 10" % TELEGRAM_INLINE_MAX_RESULTS,
+                    default=10)
+parser.add_argument("--cursor-ttl", type=float, help="Seconds the results of a query are kept to answer its next "
+                                                     "pages. Default is 60", default=60.0)
+parser.add_argument("--ranking-half-life", type=float, help="Days after which a use counts half towards the "
+                                                            "popularity of a sound. Default is 7", default=7.0)
+parser.add_argument("--ranking-interval", type=float, help="Minutes between saves of the popularity of the sounds, "
+                                                           "which also sort results again. Default is 10",
+                    default=10.0)
 
 
 args = parser.parse_args()
@@ -76,7 +196,7 @@ logger.set_log_level(args.verbosity)
 try:
     args.token = os.environ[_ENV_TELEGRAM_BOT_TOKEN]
 except KeyError as key_error:
-    if not args.token:
+    if not args.token and not args.compact:
         LOG.critical(
             'No telegram bot token provided. Please do so using --token argument or %s environment variable.',
             _ENV_TELEGRAM_BOT_TOKEN)
@@ -125,6 +245,86 @@ try:
 except KeyError:
     pass
 
+try:
+    args.sqlite_journal_mode = os.environ[_ENV_SQLITE_JOURNAL_MODE]
+except KeyError:
+    pass
+
+try:
+    args.sqlite_synchronous = os.environ[_ENV_SQLITE_SYNCHRONOUS]
+except KeyError:
+    pass
+
+try:
+    args.sqlite_mmap_size = int(os.environ[_ENV_SQLITE_MMAP_SIZE])
+except KeyError:
+    pass
+
+try:
+    args.db_connect_timeout = int(os.environ[_ENV_DB_CONNECT_TIMEOUT])
+except KeyError:
+    pass
+
+try:
+    args.retention_days = int(os.environ[_ENV_RETENTION_DAYS])
+except KeyError:
+    pass
+
+try:
+    args.query_idle_window = float(os.environ[_ENV_QUERY_IDLE_WINDOW])
+except KeyError:
+    pass
+
+try:
+    args.metrics_port = int(os.environ[_ENV_METRICS_PORT])
+except KeyError:
+    pass
+
+try:
+    args.log_sample_every = int(os.environ[_ENV_LOG_SAMPLE_EVERY])
+except KeyError:
+    pass
+
+try:
+    args.async_mode = os.environ[_ENV_ASYNC_MODE].lower() in ('1', 'true', 'yes')
+except KeyError:
+    pass
+
+try:
+    args.sounds_dir = os.environ[_ENV_SOUNDS_DIR]
+except KeyError:
+    pass
+
+try:
+    args.media_chat = os.environ[_ENV_MEDIA_CHAT]
+except KeyError:
+    pass
+
+try:
+    args.serve_sounds = os.environ[_ENV_SERVE_SOUNDS].lower() in ('1', 'true', 'yes')
+except KeyError:
+    pass
+
+try:
+    args.sounds_host = os.environ[_ENV_SOUNDS_HOST]
+except KeyError:
+    pass
+
+try:
+    args.sounds_port = int(os.environ[_ENV_SOUNDS_PORT])
+except KeyError:
+    pass
+
+try:
+    args.ranking_half_life = float(os.environ[_ENV_RANKING_HALF_LIFE])
+except KeyError:
+    pass
+
+try:
+    args.ranking_interval = float(os.environ[_ENV_RANKING_INTERVAL])
+except KeyError:
+    pass
+
 try:
     args.webhook_host = os.environ[_ENV_WEBHOOK_HOST]
 except KeyError:
@@ -145,122 +345,325 @@ try:
 except KeyError:
     pass
 
+try:
+    args.webhook_workers = int(os.environ[_ENV_WEBHOOK_WORKERS])
+except KeyError:
+    pass
+
+try:
+    args.webhook_processes = int(os.environ[_ENV_WEBHOOK_PROCESSES])
+except KeyError:
+    pass
+
+try:
+    args.search = os.environ[_ENV_SEARCH_MODE]
+except KeyError:
+    pass
+
+if args.webhook_processes > 1 and not args.webhook_host:
+    parser.error('--webhook-processes requires --webhook-host')
+# Set when this process is a worker started by the supervisor of --webhook-processes.
+worker = supervisor.Worker.from_environment()
+pool = None
+
+if args.serve_sounds:
+    if not args.sounds_dir or not (args.webhook_host or args.sounds_host):
+        parser.error('--serve-sounds requires --sounds-dir and either --webhook-host or --sounds-host')
+    sound_files = static.SoundFiles(args.sounds_dir)
+    # Results link to the sounds where this process serves them.
+    if args.webhook_host:
+        BUCKET = 'https://{}:{}{}'.format(args.webhook_host, args.webhook_port, static.SOUNDS_PATH)
+    else:
+        BUCKET = 'http://{}:{}{}'.format(args.sounds_host, args.sounds_port, static.SOUNDS_PATH)
+else:
+    sound_files = None
+
 LOG.info('Starting up bot...')
-if args.sqlite and args.mysql_host:
+tuning = db_tuning.Tuning(sqlite_journal_mode=args.sqlite_journal_mode.upper(),
+                          sqlite_synchronous=args.sqlite_synchronous.upper(),
+                          sqlite_mmap_size=args.sqlite_mmap_size,
+                          connect_timeout=args.db_connect_timeout)
+if args.sqlite and args.mysql_host and not worker:
     LOG.info("SQLite and MySQL databases on arguments. Attempting data migration...")
     try:
-        sqlite = Database('sqlite', filename=args.sqlite, create=False)
+        sqlite = Database('sqlite', filename=args.sqlite, create=False, tuning=tuning)
         mysql = Database('mysql', host=args.mysql_host, port=args.mysql_port, database_name=args.database,
-                         user=args.mysql_user, password=args.mysql_password)
-        migrate(sqlite, mysql)
+                         user=args.mysql_user, password=args.mysql_password, tuning=tuning)
+        migrate(sqlite, mysql, chunk_size=args.migration_chunk_size,
+                checkpoint_path=args.migration_checkpoint or args.sqlite + '.migration')
     except OSError as e:
         LOG.info("Migration aborted: %s.", e.args)
 if args.mysql_host:
     LOG.info('Using MySQL as persistence layer: host %s port %s', args.mysql_host, args.mysql_port)
     database = Database('mysql', host=args.mysql_host, port=args.mysql_port, database_name=args.database,
-                        user=args.mysql_user, password= args.mysql_password)
+                        user=args.mysql_user, password= args.mysql_password, tuning=tuning,
+                        user_cache_size=args.user_cache_size, user_cache_ttl=args.user_cache_ttl)
 else:
     LOG.info('Using SQLite as persistence layer.')
-    database = Database('sqlite', filename=args.sqlite)
-
-bot = telebot.TeleBot(args.token)
+    database = Database('sqlite', filename=args.sqlite, tuning=tuning,
+                        user_cache_size=args.user_cache_size, user_cache_ttl=args.user_cache_ttl)
+
+if args.compact or args.retention_days:
+    retention = Retention(database, keep_days=args.retention_days or 30, archive_dir=args.retention_archive_dir)
+    if args.compact:
+        retention.run()
+        exit(0)
+    if not worker:
+        retention.start(args.retention_interval * 3600)
+
+history = writebehind.WriteBehindQueue(database, max_size=args.history_queue_size,
+                                       batch_size=args.history_batch_size,
+                                       flush_interval=args.history_flush_interval,
+                                       drop_policy=args.history_drop_policy).start()
+atexit.register(history.stop)
+if args.query_idle_window > 0:
+    queries = QueryCoalescer(history, idle_window=args.query_idle_window).start()
+    # Registered after history so it is stopped first and its last queries are still written.
+    atexit.register(queries.stop)
+else:
+    queries = None
+recent_sounds = RecentSoundsCache(database, capacity=args.recent_cache_size)
+cursors = paging.Cursors(first_page_size=args.first_page_size, page_size=TELEGRAM_INLINE_MAX_RESULTS,
+                         ttl=args.cursor_ttl)
+stats = Stats(database)
+popularity = ranking.Ranking(database, stats, half_life_days=args.ranking_half_life).load()
+# Logs written for every inline query or result, sampled so that they stay cheap at DEBUG.
+UPDATES_LOG = logger.get_sampled_logger('updates', args.log_sample_every)
+
+HANDLER_SECONDS = metrics.histogram('quakesounds_handler_seconds', 'Duration of update handlers.', ['handler'])
+HANDLER_ERRORS = metrics.counter('quakesounds_handler_errors_total', 'Update handlers that failed.', ['handler'])
+TELEGRAM_API_SECONDS = metrics.histogram('quakesounds_telegram_api_seconds', 'Duration of Telegram Bot API calls.',
+                                         ['method'])
+metrics.callback('quakesounds_history_queue_depth', 'History events waiting to be written.', history.depth)
+metrics.callback('quakesounds_history_events_total', 'History events written or dropped.',
+                 lambda: {('written',): history.written, ('dropped',): history.dropped},
+                 metric_type=metrics.COUNTER, labelnames=['outcome'])
+metrics.callback('quakesounds_pending_queries', 'Users with a typing burst not saved yet.',
+                 lambda: queries.pending() if queries else 0)
+metrics.callback('quakesounds_catalogue_sounds', 'Sounds being served.', lambda: len(catalogue))
+
+
+def cache_counters(counter):
+    normalized = normalizer.normalize.cache_info()
+    return {('recent_sounds',): getattr(recent_sounds, counter),
+            ('users',): getattr(database.user_cache, counter),
+            ('answers',): getattr(catalogue.results, counter),
+            ('cursors',): getattr(cursors, counter),
+            ('normalized_queries',): getattr(normalized, counter)}
+
+
+metrics.callback('quakesounds_cache_hits_total', 'Cache lookups that hit.', lambda: cache_counters('hits'),
+                 metric_type=metrics.COUNTER, labelnames=['cache'])
+metrics.callback('quakesounds_cache_misses_total', 'Cache lookups that missed.', lambda: cache_counters('misses'),
+                 metric_type=metrics.COUNTER, labelnames=['cache'])
+
+
+def send_telegram_request(method, url, **kwargs):
+    # Same request pyTelegramBotAPI sends by default, timed. The method is the last part of the url.
+    with metrics.timer(TELEGRAM_API_SECONDS, url.rsplit('/', 1)[-1]):
+        return telebot.apihelper._get_req_session().request(method, url, **kwargs)
+
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = send_telegram_request
+
+# In webhook mode updates are already processed concurrently by the webhook dispatcher.
+bot = telebot.TeleBot(args.token, threaded=not args.webhook_host)
+handlers = Handlers(HANDLER_SECONDS, HANDLER_ERRORS)
+if args.sounds_dir and args.media_chat and not worker:
+    media_cache = media.MediaCache(bot, database, args.sounds_dir, args.media_chat, mode=args.media_upload,
+                                   on_uploaded=lambda: refresh_catalogue()).start()
+    atexit.register(media_cache.stop)
+    metrics.callback('quakesounds_media_uploads_pending', 'Sound files waiting to be uploaded.', media_cache.pending)
+else:
+    media_cache = None
 
 
-@bot.message_handler(commands=['start'])
+@handlers.route('message_handler', blocking=True, commands=['start'])
 def send_welcome(message):
     LOG.debug(message)
     cid = message.chat.id
-    bot.send_message(cid,
-                     "This is an inline bot. Type its name in a conversation to use it.")
     database.add_or_update_user(message.from_user)
+    return [reply('send_message', cid, "This is an inline bot. Type its name in a conversation to use it.")]
 
 
-@bot.inline_handler(lambda query: query.query == '')
+@handlers.route('inline_handler', blocking=True, func=lambda query: query.query == '')
 def query_empty(inline_query):
-    LOG.debug(inline_query)
-    r = []
-    recently_used_sounds = database.get_latest_used_sounds_from_user(inline_query.from_user.id)
-    for sound in recently_used_sounds:
-        r.append(types.InlineQueryResultVoice(
-            sound.id, BUCKET + sound.filename, '🕚 '+sound.text, caption=sound.text))
-    for sound in sounds:
-        if sound in recently_used_sounds:
-            continue
-        r.append(types.InlineQueryResultVoice(
-            sound.id, BUCKET + sound.filename, sound.text, caption=sound.text))
-        if len(r) > TELEGRAM_INLINE_MAX_RESULTS:  # https://core.telegram.org/bots/api#answerinlinequery
-            break
-    bot.answer_inline_query(inline_query.id, r, is_personal=True, cache_time=0)
+    UPDATES_LOG.debug('Inline query: %s', inline_query)
+    current = catalogue
+    user_id = inline_query.from_user.id
+    # Recently used sounds first, then the rest by popularity among users of the same language. The
+    # first page reads them again, the next ones skip the same sounds as the first one did.
+    if inline_query.offset:
+        recently_used_sounds = []
+        recent_ids = cursors.get((user_id, ''), lambda: [sound.id for sound in recent_sounds.get(user_id)])
+    else:
+        recently_used_sounds = recent_sounds.get(user_id)
+        recent_ids = cursors.get((user_id, ''), lambda: [sound.id for sound in recently_used_sounds], refresh=True)
+    sounds, next_offset = cursors.walk(current.ranked(inline_query.from_user.language_code), inline_query.offset,
+                                       skip=set(recent_ids), key=lambda sound: sound.id,
+                                       head=len(recently_used_sounds))
+    answer = current.results.answer(sounds, recently_used_sounds)
+    if inline_query.offset:
+        return [reply('answer_inline_query', inline_query.id, [answer], is_personal=True,
+                      cache_time=EMPTY_QUERY_PAGE_CACHE_TIME, next_offset=next_offset)]
     on_query(inline_query)
+    return [reply('answer_inline_query', inline_query.id, [answer], is_personal=True,
+                  cache_time=EMPTY_QUERY_CACHE_TIME, next_offset=next_offset)]
 
 
-@bot.inline_handler(lambda query: query.query)
+@handlers.route('inline_handler', func=lambda query: query.query)
 def query_text(inline_query):
-    LOG.debug(inline_query)
+    UPDATES_LOG.debug('Inline query: %s', inline_query)
     try:
-        text = unidecode.unidecode(inline_query.query.translate(REMOVE_CHARS).lower())
-        LOG.debug("Querying: " + text)
-        r = []
-        for sound in sounds:
-            if text in sound.tags:  # FIXME: Improve search
-                r.append(types.InlineQueryResultVoice(
-                    sound.id, BUCKET + sound.filename, sound.text, caption=sound.text))
-            if len(r) > TELEGRAM_INLINE_MAX_RESULTS:
-                break
-        bot.answer_inline_query(inline_query.id, r, cache_time=5)
+        key = normalizer.normalize(inline_query.query)
+        current = catalogue
+
+        def build_page():
+            # Matches are the same for every user, so they all scroll through a single list.
+            sounds, next_offset = cursors.search((None, key), lambda limit: current.search_index.search(key, limit),
+                                                 inline_query.offset)
+            return current.results.answer(sounds), next_offset
+        answer, next_offset = current.results.cached_answer((key, inline_query.offset), build_page)
+        if inline_query.offset:
+            return [reply('answer_inline_query', inline_query.id, [answer], cache_time=TEXT_QUERY_PAGE_CACHE_TIME,
+                          next_offset=next_offset)]
         on_query(inline_query)
+        return [reply('answer_inline_query', inline_query.id, [answer], cache_time=TEXT_QUERY_CACHE_TIME,
+                      next_offset=next_offset)]
     except Exception as e:
-        LOG.error("Query aborted" + str(e), e)
+        HANDLER_ERRORS.labels('query_text').inc()
+        LOG.error("Query aborted: %s", e)
 
 
-@bot.chosen_inline_handler(func=lambda chosen_inline_result: True)
+@handlers.route('chosen_inline_handler', func=lambda chosen_inline_result: True)
 def on_result(chosen_inline_result):
-    LOG.debug('Chosen result: %s', str(chosen_inline_result))
+    UPDATES_LOG.debug('Chosen result: %s', chosen_inline_result)
     try:
-        database.add_result(chosen_inline_result)
+        if queries:
+            # The query that led to this result ends the typing burst.
+            queries.flush(chosen_inline_result.from_user.id)
+        history.add_result(chosen_inline_result)
+        sound = catalogue.by_id.get(int(chosen_inline_result.result_id))
+        if sound:
+            recent_sounds.record(chosen_inline_result.from_user.id, sound)
+            if worker:
+                # Recorded by the supervisor, which also tells the other workers.
+                worker.send({'type': supervisor.RESULT, 'user': chosen_inline_result.from_user.id,
+                             'sound': sound.id, 'language': chosen_inline_result.from_user.language_code})
+            else:
+                record_result(sound, chosen_inline_result.from_user.language_code)
     except Exception as e:
-        LOG.error("Couldn't save result" + str(e), e)
+        HANDLER_ERRORS.labels('on_result').inc()
+        LOG.error("Couldn't save result: %s", e)
+
+
+def record_result(sound, language_code):
+    popularity.record(sound.id, language_code)
+    if media_cache:
+        media_cache.request(sound)
 
 
 def on_query(query):
     try:
-        database.add_query(query)
+        if queries:
+            queries.add_query(query)
+        else:
+            history.add_query(query)
     except Exception as e:
-        LOG.error("Couldn't save query" + str(e), e)
+        LOG.error("Couldn't save query: %s", e)
 
 
 def synchronize_sounds():
-    db_sounds = database.get_sounds(include_disabled=False)
-    LOG.debug("Sounds in db (%d)", len(db_sounds))
-
-    b_data_json = open(args.data).read()
-    data_json = json.loads(b_data_json)
+    with open(args.data) as data_file:
+        data_json = json.load(data_file)
 
     json_sounds = data_json["sounds"]
     LOG.debug("Sounds in data.json (%d)", len(json_sounds))
 
-    # Adding new sounds to db
-    for jsound in json_sounds:
-        query = database.get_sound(filename=jsound["filename"])
-        if not query:
-            jsound["id"] = ''.join(random.choices(string.digits, k=8))
-            database.add_sound(jsound["id"], jsound["filename"], jsound["text"], jsound["tags"])
-
-    # Removing deleted sounds from db
-    db_sounds = database.get_sounds(include_disabled=False)
-    for db_sound in db_sounds:
-        found = None
-        for jsound in json_sounds:
-            if jsound["filename"] == db_sound.filename:
-                found = jsound
-                break
-        if not found:
-            database.delete_sound(db_sound)
-            db_sounds.remove(db_sound)
-
+    db_sounds, report = database.sync_sounds(json_sounds)
+    for filename in report.added:
+        LOG.debug("Added sound %s", filename)
+    for filename in report.updated:
+        LOG.debug("Updated sound %s", filename)
+    for filename in report.disabled:
+        LOG.debug("Disabled sound %s", filename)
     return db_sounds
 
 
+def build_catalogue(sounds, file_ids=None):
+    if media_cache:
+        file_ids = media_cache.file_ids(sounds)
+    paths = sound_files.paths() if sound_files else None
+    return Catalogue(sounds, BUCKET, args.search, file_ids=file_ids, paths=paths, orders=popularity.orders(sounds))
+
+
+def reload_sounds():
+    global catalogue
+    with reload_lock:
+        if sound_files:
+            sound_files.refresh()
+        reloaded = build_catalogue(synchronize_sounds())
+        catalogue = reloaded
+        cursors.invalidate()
+        publish_catalogue()
+    LOG.info('Reloaded catalogue, serving %i sounds.', len(reloaded))
+    return reloaded
+
+
+def refresh_catalogue():
+    # Same sounds, sorted by their current popularity and answered with the file_ids uploaded since
+    # the catalogue was built.
+    global catalogue
+    with reload_lock:
+        catalogue = build_catalogue(catalogue.sounds)
+        cursors.invalidate()
+        publish_catalogue()
+    LOG.debug('Refreshed catalogue, serving %i sounds by file_id.', len(catalogue.results.file_ids))
+
+
+def catalogue_snapshot():
+    return {'sounds': catalogue.sounds, 'file_ids': catalogue.results.file_ids}
+
+
+def publish_catalogue():
+    # Workers load the catalogue of the supervisor, along with the popularity it last saved.
+    if pool:
+        pool.publish(catalogue_snapshot())
+
+
+def load_catalogue_snapshot():
+    global catalogue
+    snapshot = worker.snapshot()
+    popularity.load()
+    with reload_lock:
+        if sound_files:
+            sound_files.refresh()
+        catalogue = build_catalogue(snapshot['sounds'], file_ids=snapshot['file_ids'])
+        cursors.invalidate()
+    LOG.info('Loaded catalogue snapshot, serving %i sounds.', len(catalogue))
+
+
+def on_supervisor_message(message):
+    if message['type'] == supervisor.RELOAD:
+        load_catalogue_snapshot()
+    elif message['type'] == supervisor.RECENT:
+        sound = catalogue.by_id.get(message['sound'])
+        if sound:
+            recent_sounds.record(message['user'], sound)
+
+
+def on_worker_message(index, message):
+    if message['type'] == supervisor.RESULT:
+        sound = catalogue.by_id.get(message['sound'])
+        if sound:
+            record_result(sound, message['language'])
+        # Other workers record it too, since the result may not be written to the database yet.
+        pool.broadcast({'type': supervisor.RECENT, 'user': message['user'], 'sound': message['sound']},
+                       exclude=index)
+    elif message['type'] == supervisor.RELOAD:
+        reload_sounds()
+
+
 # ADMIN COMMANDS
 
 def message_is_from_admin(message):
@@ -268,60 +671,152 @@ def message_is_from_admin(message):
     return from_user.username == args.admin
 
 
-@bot.message_handler(commands=['stats'], func=lambda message: message_is_from_admin(message))
+@handlers.route('message_handler', blocking=True, commands=['stats'], func=message_is_from_admin)
 def send_stats(message):
     LOG.debug(message)
     cid = message.chat.id
     uptime = PrettyUptime.get_pretty_python_uptime(custom_name='Bot')
-    users = database.get_users()
-    queries = database.get_queries()
-    results = database.get_results()
-    bot.send_message(cid,
-                     '🤖 {uptime}\n'
-                     '*All time stats:*\n'
-                     '👥 Users: {num_users}\n'
-                     '🔎 Queries: {num_queries}\n'
-                     '🔊 Results: {num_results}\n'.format(num_users=len(users),
-                                                         num_queries=len(queries),
-                                                         num_results=len(results),
-                                                         uptime=uptime), parse_mode='Markdown')
-
-
-@bot.message_handler(commands=['uptime'], func=lambda message: message_is_from_admin(message))
+    totals = stats.totals()
+    active_users = stats.active_users(datetime.datetime.now() - datetime.timedelta(days=1))
+    top_sounds = ''.join('  {uses} × {text}\n'.format(uses=uses, text=text)
+                         for sound_id, text, uses in stats.sound_uses(limit=5))
+    return [reply('send_message', cid,
+                  '🤖 {uptime}\n'
+                  '*All time stats:*\n'
+                  '👥 Users: {num_users}\n'
+                  '🔎 Queries: {num_queries} ({num_keystrokes} typed)\n'
+                  '🔊 Results: {num_results}\n'
+                  '*Top sounds:*\n'
+                  '{top_sounds}'
+                  '*Last 24h:*\n'
+                  '👥 Active users: {active_users}\n'
+                  '🗃 Recent sounds cache: {cache_hits} hits, {cache_misses} misses '
+                  '({cache_hit_rate:.0%})\n'
+                  '👤 User cache: {user_cache_hit_rate:.0%} hits\n'.format(
+                      num_users=totals['users'],
+                      num_queries=totals['queries'],
+                      num_keystrokes=totals['keystrokes'],
+                      num_results=totals['results'],
+                      top_sounds=top_sounds,
+                      active_users=active_users,
+                      cache_hits=recent_sounds.hits,
+                      cache_misses=recent_sounds.misses,
+                      cache_hit_rate=recent_sounds.hit_rate(),
+                      user_cache_hit_rate=database.user_cache.hit_rate(),
+                      uptime=uptime), parse_mode='Markdown')]
+
+
+@handlers.route('message_handler', blocking=True, commands=['topqueries'], func=message_is_from_admin)
+def send_top_queries(message):
+    LOG.debug(message)
+    cid = message.chat.id
+    daily_active_users = ''.join('{day}: {users}\n'.format(day=day, users=users)
+                                 for day, users in stats.daily_active_users(days=7))
+    top_queries = ''.join('{times} × {text}\n'.format(times=times, text=text)
+                          for text, times in stats.top_queries(limit=20, days=7))
+    return [reply('send_message', cid,
+                  '📅 Daily active users:\n'
+                  '{daily_active_users}\n'
+                  '🔎 Top queries (7 days):\n'
+                  '{top_queries}'.format(daily_active_users=daily_active_users or '-\n',
+                                         top_queries=top_queries or '-\n'))]
+
+
+@handlers.route('message_handler', blocking=True, commands=['reload'], func=message_is_from_admin)
+def send_reload(message):
+    LOG.debug(message)
+    cid = message.chat.id
+    if worker:
+        worker.send({'type': supervisor.RELOAD})
+        return [reply('send_message', cid, "🔄 Reloading in every worker.")]
+    try:
+        reloaded = reload_sounds()
+    except Exception as e:
+        LOG.error("Couldn't reload sounds: %s", e)
+        return [reply('send_message', cid, "❌ Couldn't reload sounds: {error}".format(error=e))]
+    return [reply('send_message', cid, "🔄 Reloaded, serving {num_sounds} sounds.".format(num_sounds=len(reloaded)))]
+
+
+@handlers.route('message_handler', blocking=True, commands=['uptime'], func=message_is_from_admin)
 def send_uptime(message):
     LOG.debug(message)
     cid = message.chat.id
     py_uptime = PrettyUptime.get_pretty_python_uptime(custom_name='Bot')
     machine_uptime = PrettyUptime.get_pretty_machine_uptime_string()
     machine_info = PrettyUptime.get_pretty_machine_info()
-    bot.send_message(cid,
-                     '💻 {machine_info}\n'
-                     '⌛ {machine_uptime}\n'
-                     '🤖 {py_uptime}\n'
-                     .format(machine_info=machine_info, machine_uptime=machine_uptime, py_uptime=py_uptime))
-
-
-sounds = synchronize_sounds()
-LOG.info('Serving %i sounds.', len(sounds))
-
-if args.webhook_host:
-    webhook.start_webhook(bot, args.webhook_host, args.webhook_port, args.webhook_listening, args.webhook_listening_port)
-else:
-    try:
-        bot.remove_webhook()
-    except telebot.apihelper.ApiException as e:
-        LOG.debug(e)
-    while True:
+    return [reply('send_message', cid,
+                  '💻 {machine_info}\n'
+                  '⌛ {machine_uptime}\n'
+                  '🤖 {py_uptime}\n'
+                  .format(machine_info=machine_info, machine_uptime=machine_uptime, py_uptime=py_uptime))]
+
+
+handlers.register(bot)
+
+
+reload_lock = threading.Lock()
+with reload_lock:
+    # Held so that uploads finishing meanwhile wait for the catalogue they refresh.
+    if worker:
+        snapshot = worker.snapshot()
+        catalogue = build_catalogue(snapshot['sounds'], file_ids=snapshot['file_ids'])
+    else:
+        catalogue = build_catalogue(synchronize_sounds())
+LOG.info('Serving %i sounds using %s search.', len(catalogue), args.search)
+if args.ranking_interval > 0 and not worker:
+    popularity.start(args.ranking_interval * 60, on_snapshot=refresh_catalogue)
+    atexit.register(popularity.stop)
+
+# Everything above can be imported, by the benchmarks, without serving anything.
+if __name__ == '__main__':
+    if args.metrics_port and not worker:
+        metrics.start_http_server(args.metrics_port)
+        LOG.info('Serving metrics on port %d.', args.metrics_port)
+    if args.data_watch_interval > 0 and not worker:
+        FileWatcher(args.data, reload_sounds, args.data_watch_interval).start()
+
+    if worker:
+        worker.start(on_supervisor_message)
+    elif args.webhook_processes > 1:
+        webhook.set_webhook(bot, args.webhook_host, args.webhook_port)
+        # Saved so that workers load the popularity instead of computing it again from the history.
+        popularity.snapshot()
+        pool = supervisor.Supervisor(args.webhook_processes, args.webhook_listening, args.webhook_listening_port,
+                                     on_worker_message)
+        metrics.callback('quakesounds_webhook_processes', 'Worker processes serving the webhook.', pool.alive)
+        pool.start(catalogue_snapshot())
+        pool.run()
+        exit(0)
+
+    if sound_files and not args.webhook_host:
+        static.start_server(sound_files, args.webhook_listening, args.sounds_port)
+    runtime = None
+    if args.async_mode:
+        # Imported only when used, AsyncTeleBot needs a newer Python than the threaded bot.
+        from asyncbot import AsyncRuntime
+        runtime = AsyncRuntime(args.token, handlers, workers=args.webhook_workers)
+    if args.webhook_host:
+        webhook.start_webhook(bot, args.webhook_host, args.webhook_port, args.webhook_listening,
+                              args.webhook_listening_port, workers=args.webhook_workers, runtime=runtime,
+                              sound_files=sound_files, sock=worker.listen_socket if worker else None)
+    elif runtime:
+        runtime.polling()
+    else:
         try:
-            sleep(1)
-            LOG.debug("Polling started")
-            bot.polling()
-        except requests.exceptions.ConnectionError as connection_error:
-            LOG.error("ConnectionError: Cannot connect to server.")
-            LOG.debug(connection_error)
-        except requests.exceptions.ReadTimeout as read_timeout:
-            LOG.error("ReadTimeout: Lost connection to the server.")
-            LOG.debug(read_timeout)
-        except Exception as e:
-            LOG.critical(e)
-            raise e
\ No newline at end of file
+            bot.remove_webhook()
+        except telebot.apihelper.ApiException as e:
+            LOG.debug(e)
+        while True:
+            try:
+                sleep(1)
+                LOG.debug("Polling started")
+                bot.polling()
+            except requests.exceptions.ConnectionError as connection_error:
+                LOG.error("ConnectionError: Cannot connect to server.")
+                LOG.debug(connection_error)
+            except requests.exceptions.ReadTimeout as read_timeout:
+                LOG.error("ReadTimeout: Lost connection to the server.")
+                LOG.debug(read_timeout)
+            except Exception as e:
+                LOG.critical(e)
+                raise e
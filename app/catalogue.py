@@ -0,0 +1,28 @@
+import ranking
+from results import ResultCatalog
+from search import SearchIndex
+
+
+class Catalogue:
+    """Sounds being served along with every structure derived from them.
+
+    A catalogue is never modified once built. Reloading builds a new one and replaces the reference,
+    so a handler that reads the current catalogue once sees a consistent state for the whole request.
+
+    orders, from ranking.Ranking.orders(), gives the sounds sorted by popularity globally and per
+    language. The global order is the order of the catalogue, so search results follow it too.
+    """
+
+    def __init__(self, sounds, bucket, search_mode, file_ids=None, paths=None, orders=None):
+        self.orders = orders or {ranking.GLOBAL: sounds}
+        self.sounds = self.orders[ranking.GLOBAL]
+        self.by_id = {sound.id: sound for sound in self.sounds}
+        self.search_index = SearchIndex(self.sounds, search_mode)
+        self.results = ResultCatalog(self.sounds, bucket, file_ids=file_ids, paths=paths)
+
+    def ranked(self, language_code):
+        """Sounds sorted by popularity among users with language_code."""
+        return self.orders.get(ranking.language(language_code), self.sounds)
+
+    def __len__(self):
+        return len(self.sounds)
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logger
+
+
+def update_key(update):
+    """Key used to serialize updates: the sender, or the update itself when it has none."""
+    for field in ('message', 'edited_message', 'inline_query', 'chosen_inline_result', 'callback_query'):
+        event = getattr(update, field, None)
+        if event is not None and getattr(event, 'from_user', None) is not None:
+            return event.from_user.id
+    return ('update', update.update_id)
+
+
+class UpdateDispatcher:
+    """Processes bot updates on a bounded thread pool.
+
+    Updates from different users run concurrently, while updates from the same user are processed
+    one after the other in arrival order.
+    """
+
+    def __init__(self, bot, workers=8):
+        global LOG
+        LOG = logger.get_logger('dispatcher')
+        self.bot = bot
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='updates')
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, update, on_done=None):
+        """Queues update and returns immediately. on_done is called once the update is processed."""
+        key = update_key(update)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                pending.append((update, on_done))
+                return
+            self._pending[key] = deque([(update, on_done)])
+        self._executor.submit(self._drain, key)
+
+    def in_flight(self):
+        with self._lock:
+            return sum(len(pending) for pending in self._pending.values())
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                pending = self._pending[key]
+                update, on_done = pending[0]
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                LOG.error('Update %s failed: %s', update.update_id, e)
+            finally:
+                with self._lock:
+                    pending.popleft()
+                    if not pending:
+                        del self._pending[key]
+                if on_done is not None:
+                    on_done()
+            if not pending:
+                return
+
+
+class AsyncUpdateDispatcher:
+    """Processes bot updates as tasks of the running event loop, with process(update), a coroutine.
+
+    Like UpdateDispatcher, updates from the same user run one after the other in arrival order, so
+    that a chosen result is never handled before the inline query that listed it.
+    """
+
+    def __init__(self, process):
+        global LOG
+        LOG = logger.get_logger('dispatcher')
+        self.process = process
+        self._last = {}
+
+    def submit(self, update, on_done=None):
+        """Schedules update after the previous update of its sender. on_done is called once it is processed."""
+        key = update_key(update)
+        task = asyncio.ensure_future(self._run(self._last.get(key), update))
+        self._last[key] = task
+
+        def done(task):
+            if self._last.get(key) is task:
+                del self._last[key]
+            if on_done is not None:
+                on_done()
+        task.add_done_callback(done)
+        return task
+
+    def in_flight(self):
+        return len(self._last)
+
+    async def _run(self, previous, update):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await self.process(update)
+        except Exception as e:
+            LOG.error('Update %s failed: %s', update.update_id, e)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Update handlers shared by the threaded and the asyncio runtimes.
+
+Handlers return the Bot API calls to make, as Reply tuples, instead of making them. The threaded
+TeleBot runs a handler and makes its calls on the same thread, while asyncbot.AsyncRuntime awaits
+them on its event loop.
+"""
+
+import functools
+from collections import namedtuple
+import metrics
+
+Reply = namedtuple('Reply', 'method args kwargs')
+Route = namedtuple('Route', 'kind filters name build blocking')
+
+
+def reply(method, *args, **kwargs):
+    """Call of the bot method with the given arguments."""
+    return Reply(method, args, kwargs)
+
+
+class Handlers:
+    """Registry of the update handlers of the bot.
+
+    histogram and errors are the metrics where the duration and the failures of every handler are
+    recorded, labelled with the handler name.
+    """
+
+    def __init__(self, histogram, errors):
+        self.histogram = histogram
+        self.errors = errors
+        self.routes = []
+        self.bot = None
+        self._handles = {}
+
+    def route(self, kind, blocking=False, **filters):
+        """Decorator adding a handler to register with bot.<kind>(**filters).
+
+        blocking tells the asyncio runtime that the handler waits on the database or on files, so
+        that it runs it on a worker thread. The decorated function is replaced by one that makes
+        the calls it returns with the threaded bot given to register().
+        """
+        def decorator(build):
+            self.routes.append(Route(kind, filters, build.__name__, build, blocking))
+
+            @metrics.timed(self.histogram, build.__name__, errors=self.errors)
+            @functools.wraps(build)
+            def handle(update):
+                for call in build(update) or ():
+                    getattr(self.bot, call.method)(*call.args, **call.kwargs)
+            self._handles[build.__name__] = handle
+            return handle
+        return decorator
+
+    def register(self, bot):
+        """Registers every handler in the threaded TeleBot bot."""
+        self.bot = bot
+        for route in self.routes:
+            getattr(bot, route.kind)(**route.filters)(self._handles[route.name])
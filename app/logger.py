@@ -1,4 +1,7 @@
+import itertools
 import logging
+import logging.handlers
+import queue
 DEFAULT_LOG_LEVEL = logging.DEBUG
 DEFAULT_FORMATTER = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
@@ -21,6 +24,7 @@ def set_log_level(verbosity):
     numeric_level = get_numeric_log_level(verbosity)
     for c_logger in logger.handlers:
         c_logger.setLevel(numeric_level)
+    _update_logger_level()
 
 
 def get_numeric_log_level(verbosity):
@@ -36,8 +40,69 @@ def get_logger(name=None):
     return logger
 
 
-def add_file_handler(file_path, log_level=DEFAULT_LOG_LEVEL, formatter=DEFAULT_FORMATTER):
+def get_sampled_logger(name, every):
+    """Child logger that only lets one of every `every` records through, for logs written per update."""
+    sampled_logger = get_logger(name)
+    for sampling_filter in [f for f in sampled_logger.filters if isinstance(f, SamplingFilter)]:
+        sampled_logger.removeFilter(sampling_filter)
+    if every > 1:
+        sampled_logger.addFilter(SamplingFilter(every))
+    return sampled_logger
+
+
+class SamplingFilter(logging.Filter):
+    """Passes the first record and then one of every `every` records."""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self._records = itertools.count()
+
+    def filter(self, record):
+        # next() on itertools.count is atomic, so no lock is needed between threads.
+        return next(self._records) % self.every == 0
+
+
+def add_file_handler(file_path, log_level=DEFAULT_LOG_LEVEL, formatter=DEFAULT_FORMATTER, queued=True):
+    """Logs to file_path and returns the handler added to the logger.
+
+    When queued, records are formatted and written by the thread of handler.listener, so callers
+    never wait for disk I/O. Closing the handler writes the records still queued.
+    """
     fh = logging.FileHandler(file_path)
     fh.setLevel(log_level)
     fh.setFormatter(formatter)
-    logger.addHandler(fh)
\ No newline at end of file
+    if queued:
+        handler = _DeferredQueueHandler(queue.Queue())
+        handler.setLevel(log_level)
+        handler.listener = logging.handlers.QueueListener(handler.queue, fh, respect_handler_level=True)
+        handler.listener.start()
+    else:
+        handler = fh
+    logger.addHandler(handler)
+    _update_logger_level()
+    return handler
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    listener = None
+
+    # QueueHandler formats records before queueing them, so they can cross process boundaries.
+    # The queue is only read by a thread of this process, which formats them instead.
+    def prepare(self, record):
+        return record
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+        super().close()
+
+
+def _update_logger_level():
+    # With the logger at the lowest level of its handlers, records no handler would emit are
+    # discarded by isEnabledFor() before they are even created.
+    levels = [handler.level for handler in logger.handlers if handler.level != logging.NOTSET]
+    logger.setLevel(min(levels) if levels else DEFAULT_LOG_LEVEL)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import queue
+import threading
+import logger
+
+UPLOAD_EAGER = 'eager'
+UPLOAD_LAZY = 'lazy'
+UPLOAD_MODES = (UPLOAD_EAGER, UPLOAD_LAZY)
+
+
+def content_hash(path, chunk_size=1 << 16):
+    """Hex SHA-256 of the content of the file at path."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as sound_file:
+        for chunk in iter(lambda: sound_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileHashes:
+    """Content hashes of the files of a directory, only computed again when a file changes."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def get(self, filename):
+        """Content hash of filename, or None when it does not exist."""
+        path = self.path(filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._hashes.get(filename)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        file_hash = content_hash(path)
+        with self._lock:
+            self._hashes[filename] = (version, file_hash)
+        return file_hash
+
+
+class MediaCache:
+    """Uploads sound files to Telegram once so that results can reference them by file_id.
+
+    Files are sent as voice messages to chat_id, and the file_id Telegram assigns them is stored in
+    the database along with the hash of the uploaded content. A sound is only uploaded again when
+    the content of its file changes. Uploads run one at a time, upload_interval seconds apart, on a
+    background thread, and on_uploaded is called once the queue of pending uploads is empty.
+
+    In eager mode every sound without a valid file_id is queued by file_ids(). In lazy mode it is
+    queued by request(), when it is first used. Sounds without a valid file_id are served by URL.
+    """
+
+    def __init__(self, bot, database, sounds_dir, chat_id, mode=UPLOAD_EAGER, upload_interval=1.0,
+                 on_uploaded=None):
+        if mode not in UPLOAD_MODES:
+            raise ValueError('Invalid upload mode: %s' % mode)
+        global LOG
+        LOG = logger.get_logger('media')
+        self.bot = bot
+        self.database = database
+        self.hashes = FileHashes(sounds_dir)
+        self.chat_id = chat_id
+        self.mode = mode
+        self.upload_interval = upload_interval
+        self.on_uploaded = on_uploaded
+        self.uploaded = 0
+        self.failed = 0
+        self._uploaded_ids = {}
+        self._queued = set()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._worker = threading.Thread(target=self._run, name='media-uploader', daemon=True)
+
+    def start(self):
+        self._worker.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self._queue.put(None)
+
+    def pending(self):
+        with self._lock:
+            return len(self._queued)
+
+    def file_ids(self, sounds):
+        """file_id of every sound whose upload matches the current content of its file."""
+        file_ids = {}
+        for sound in sounds:
+            file_hash = self.hashes.get(sound.filename)
+            if file_hash is None:
+                continue
+            file_id = self._file_id(sound, file_hash)
+            if file_id is not None:
+                file_ids[sound.id] = file_id
+            elif self.mode == UPLOAD_EAGER:
+                self._enqueue(sound, file_hash)
+        return file_ids
+
+    def request(self, sound):
+        """Queues the upload of sound unless its file is already uploaded or being uploaded."""
+        file_hash = self.hashes.get(sound.filename)
+        if file_hash is not None and self._file_id(sound, file_hash) is None:
+            self._enqueue(sound, file_hash)
+
+    def _file_id(self, sound, file_hash):
+        with self._lock:
+            uploaded = self._uploaded_ids.get(sound.id)
+        if uploaded is not None and uploaded[0] == file_hash:
+            return uploaded[1]
+        if sound.file_id and sound.content_hash == file_hash:
+            return sound.file_id
+        return None
+
+    def _enqueue(self, sound, file_hash):
+        with self._lock:
+            if (sound.id, file_hash) in self._queued:
+                return
+            self._queued.add((sound.id, file_hash))
+        self._queue.put((sound, file_hash))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            item = self._queue.get()
+            if item is None:
+                continue
+            self._upload(*item)
+            with self._lock:
+                self._queued.discard((item[0].id, item[1]))
+            if self._queue.empty() and self.on_uploaded is not None:
+                try:
+                    self.on_uploaded()
+                except Exception as e:
+                    LOG.error('Failed to apply uploaded media: %s', e)
+            self._stopping.wait(self.upload_interval)
+
+    def _upload(self, sound, file_hash):
+        try:
+            with open(self.hashes.path(sound.filename), 'rb') as sound_file:
+                message = self.bot.send_voice(self.chat_id, sound_file, caption=sound.text,
+                                              disable_notification=True)
+            file_id = message.voice.file_id
+            # Uploads may be hours apart, long enough for the server to drop the idle connection.
+            self.database.ping()
+            self.database.set_sound_media(sound.id, file_hash, file_id)
+        except Exception as e:
+            self.failed += 1
+            LOG.error('Failed to upload %s: %s', sound.filename, e)
+            return
+        with self._lock:
+            self._uploaded_ids[sound.id] = (file_hash, file_id)
+        self.uploaded += 1
+        LOG.info('Uploaded %s as %s.', sound.filename, file_id)
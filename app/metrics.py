@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""In-process metrics, rendered in the Prometheus text exposition format.
+
+Counters and histograms are updated by the code they measure. Values that already live somewhere
+else, like queue depths or cache counters, are registered as callbacks and only read when the
+metrics are rendered. Recording a value costs a dictionary lookup and a lock, so handlers and
+database calls can be measured on every call.
+"""
+
+import bisect
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+# Seconds, from fast in-memory work up to slow database and network calls.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Metric:
+
+    metric_type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """The child of this metric for the given label values, created on first use."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('{} expects labels {}, got {}'.format(self.name, self.labelnames, values))
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.metric_type)]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(dict(zip(self.labelnames, values)), child))
+        return lines
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _render_child(self, labels, child):
+        raise NotImplementedError
+
+
+class _CounterChild:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+
+    metric_type = COUNTER
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _render_child(self, labels, child):
+        return [_sample(self.name, labels, child.value)]
+
+
+class _HistogramChild:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+
+    metric_type = HISTOGRAM
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, labels, child):
+        with child._lock:
+            counts = list(child.counts)
+            total = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append(_sample(self.name + '_bucket', dict(labels, le=_format_value(bound)), cumulative))
+        lines.append(_sample(self.name + '_sum', labels, total))
+        lines.append(_sample(self.name + '_count', labels, cumulative))
+        return lines
+
+
+class Callback(_Metric):
+    """Metric read from function() when rendered.
+
+    function returns a number, or a dict from tuples of label values to numbers.
+    """
+
+    def __init__(self, name, help, function, metric_type=GAUGE, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.metric_type = metric_type
+        self.function = function
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.metric_type)]
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            lines.append(_sample(self.name, dict(zip(self.labelnames, label_values)), value))
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Adds metric, replacing a previous one with the same name."""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name, help, function, metric_type=GAUGE, labelnames=()):
+        return self.register(Callback(name, help, function, metric_type, labelnames))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.counter(name, help, labelnames)
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, help, labelnames, buckets)
+
+
+def callback(name, help, function, metric_type=GAUGE, labelnames=()):
+    return REGISTRY.callback(name, help, function, metric_type, labelnames)
+
+
+def render():
+    return REGISTRY.render()
+
+
+class timer:
+    """Context manager observing the seconds spent in its block in histogram, with label values."""
+
+    def __init__(self, histogram, *label_values):
+        self.child = histogram.labels(*label_values)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+def timed(histogram, *label_values, errors=None):
+    """Decorator observing the duration of every call in histogram.
+
+    Calls that raise are also counted in the errors counter when one is given, with the same labels.
+    """
+    def decorator(function):
+        child = histogram.labels(*label_values)
+        error_child = errors.labels(*label_values) if errors is not None else None
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                if error_child is not None:
+                    error_child.inc()
+                raise
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def start_http_server(port, address='0.0.0.0', registry=REGISTRY):
+    """Serves the metrics of registry on http://address:port/metrics from a daemon thread."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = _ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer only exists since Python 3.7.
+    daemon_threads = True
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(label, _escape(label_value))
+                               for label, label_value in labels.items()) + '}'
+    return '{} {}'.format(name, _format_value(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
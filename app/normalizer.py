@@ -0,0 +1,30 @@
+import string
+from functools import lru_cache
+import unidecode
+
+CACHE_SIZE = 4096
+
+_SEPARATORS = string.punctuation + string.whitespace
+# Lower cases ASCII bytes and turns punctuation into spaces, as it separates words just like whitespace.
+_TABLE = bytes.maketrans((_SEPARATORS + string.ascii_uppercase).encode(),
+                         (' ' * len(_SEPARATORS) + string.ascii_lowercase).encode())
+
+
+def _normalize(text):
+    try:
+        ascii_text = text.encode('ascii')
+    except UnicodeEncodeError:
+        # Only texts with non ASCII characters pay for transliteration.
+        ascii_text = unidecode.unidecode(text).encode('ascii', 'ignore')
+    return ' '.join(ascii_text.translate(_TABLE).decode('ascii').split())
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def normalize(text):
+    """Lower case ASCII words of text separated by single spaces, memoized for recent texts."""
+    return _normalize(text)
+
+
+def tokenize(text, memoize=True):
+    """Words of text as normalized by normalize(). Catalogue texts skip the memo to keep it for queries."""
+    return (normalize(text) if memoize else _normalize(text)).split()
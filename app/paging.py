@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+def encode_offset(position):
+    """Opaque inline query offset of the page starting at position."""
+    return format(position, 'x')
+
+
+def decode_offset(offset):
+    """Position of the page of an offset made by encode_offset, 0 for the first page or a bad offset."""
+    try:
+        return max(int(offset, 16), 0) if offset else 0
+    except ValueError:
+        return 0
+
+
+class Cursors:
+    """Pages of inline query results, along with a short lived cache of the lists they are cut from.
+
+    The first page is small, since clients show only a few results at a time, and the next ones as
+    big as Telegram allows. What a query needs to cut its next pages, the results found so far or
+    the sounds to skip, is kept for ttl seconds under a key, so that scrolling does not compute it
+    again and every page is cut from the same state as the first one.
+    """
+
+    def __init__(self, first_page_size=10, page_size=48, ttl=60.0, capacity=10000):
+        self.first_page_size = first_page_size
+        self.page_size = page_size
+        self.ttl = ttl
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, build, refresh=False):
+        """List stored for key, calling build() to create it when missing, expired or refresh is set."""
+        return self._get(key, build, lambda items, complete: not refresh)[0]
+
+    def search(self, key, search, offset):
+        """Page at offset of the results of search(limit), the first limit results for key, and the next offset.
+
+        Results are searched up to the end of the page after the one asked for, and kept under key.
+        They are only searched again, for more of them, when the user scrolls past the kept ones.
+        """
+        start = decode_offset(offset)
+        end = start + (self.first_page_size if start == 0 else self.page_size)
+        limit = end + self.page_size
+        items, complete = self._get(key, lambda: search(limit),
+                                    lambda items, complete: complete or len(items) > end, limit)
+        return items[start:end], encode_offset(end) if end < len(items) else ''
+
+    def _get(self, key, build, usable, limit=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now and usable(entry[1], entry[2]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+        items = list(build())
+        complete = limit is None or len(items) < limit
+        with self._lock:
+            self._entries[key] = (now + self.ttl, items, complete)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return items, complete
+
+    def page(self, items, offset):
+        """Items of the page at offset and the offset of the next page, empty after the last one."""
+        start = decode_offset(offset)
+        end = start + (self.first_page_size if start == 0 else self.page_size)
+        return items[start:end], encode_offset(end) if end < len(items) else ''
+
+    def walk(self, items, offset, skip=frozenset(), key=None, head=0):
+        """Page at offset of items without those whose key is in skip, and the offset of the next page.
+
+        Offsets are positions in items, so pages are cut from items as they are instead of from a
+        filtered copy. head is the number of results shown before items on the first page.
+        """
+        key = key or (lambda item: item)
+        position = decode_offset(offset)
+        size = max(self.first_page_size - head, 0) if not offset else self.page_size
+        page = []
+        while position < len(items) and (len(page) < size or key(items[position]) in skip):
+            if key(items[position]) not in skip:
+                page.append(items[position])
+            position += 1
+        return page, encode_offset(position) if position < len(items) else ''
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
@@ -1,13 +1,26 @@
 import datetime
+import random
+from collections import namedtuple
 from pony.orm import *
 import logger
+import metrics
+from persistence.migration import Migrator
+from persistence import tuning as db_tuning
+from persistence import schema
+from persistence.cache import UserCache
+
+SyncReport = namedtuple('SyncReport', 'added updated disabled')
+_SoundRow = namedtuple('_SoundRow', 'id filename text tags disabled file_id content_hash')
 
 
 class Database:
 
     def __init__(self, provider, filename=None, host=None, port=None, user=None, password=None, database_name=None,
-                 create=True):
+                 create=True, tuning=db_tuning.DEFAULT_TUNING, user_cache_size=100000, user_cache_ttl=3600.0):
         self.db = pony.orm.Database()
+        self.user_cache = UserCache(capacity=user_cache_size, ttl=user_cache_ttl)
+        db_tuning.register(self.db, tuning)
+        options = db_tuning.bind_options(provider, tuning)
         global LOG
         LOG = logger.get_logger('persistence')
 
@@ -18,6 +31,12 @@ class Database:
             tags = Required(str)
             uses = Set('ResultHistory')
             disabled = Required(bool)
+            recent_users = Set('UserRecentSound')
+            daily_uses = Set('DailySoundUse')
+            popularity = Set('SoundPopularity')
+            # Telegram file_id of the uploaded file and the hash of the content that was uploaded.
+            file_id = Optional(str, 255, sql_default="''")
+            content_hash = Optional(str, 64, sql_default="''")
 
         class User(self.db.Entity):
             id = PrimaryKey(int)
@@ -28,6 +47,8 @@ class Database:
             language_code = Optional(str)
             queries = Set('QueryHistory')
             results = Set('ResultHistory')
+            recent_sounds = Set('UserRecentSound')
+            daily_activity = Set('DailyUserActivity')
             first_seen = Required(datetime.datetime, sql_default='CURRENT_TIMESTAMP')
 
         class QueryHistory(self.db.Entity):
@@ -35,6 +56,7 @@ class Database:
             user = Required(User)
             text = Optional(str)
             timestamp = Required(datetime.datetime, sql_default='CURRENT_TIMESTAMP')
+            collapsed = Required(int, default=1, sql_default='1')
 
         class ResultHistory(self.db.Entity):
             id = PrimaryKey(int, auto=True)
@@ -42,24 +64,72 @@ class Database:
             sound = Required(Sound)
             timestamp = Required(datetime.datetime, sql_default='CURRENT_TIMESTAMP')
 
+        class UserRecentSound(self.db.Entity):
+            user = Required(User)
+            sound = Required(Sound)
+            last_used = Required(datetime.datetime)
+            PrimaryKey(user, sound)
+
+        # Daily rollups of the history rows removed by retention.Retention.
+        class RollupDay(self.db.Entity):
+            day = PrimaryKey(datetime.date)
+            purged = Required(bool)
+
+        class DailySoundUse(self.db.Entity):
+            day = Required(datetime.date)
+            sound = Required(Sound)
+            uses = Required(int)
+            PrimaryKey(day, sound)
+
+        class DailyUserActivity(self.db.Entity):
+            day = Required(datetime.date)
+            user = Required(User)
+            queries = Required(int)
+            results = Required(int)
+            keystrokes = Required(int, default=0, sql_default='0')
+            PrimaryKey(day, user)
+
+        # Snapshot of ranking.Ranking: decayed popularity of every sound at the time it was saved.
+        class SoundPopularity(self.db.Entity):
+            sound = Required(Sound)
+            language = Required(str, 16)
+            score = Required(float)
+            updated = Required(datetime.datetime)
+            PrimaryKey(sound, language)
+
+        class DailyQuery(self.db.Entity):
+            id = PrimaryKey(int, auto=True)
+            day = Required(datetime.date, index=True)
+            text = Required(str, 255)
+            queries = Required(int)
+
         if provider == 'mysql':
             LOG.info('Starting persistence layer using MySQL on %s:%s db: %s', host, port, database_name)
             LOG.debug('MySQL data: host --> %s, port -->%s, user --> %s, db --> %s, password empty --> %s',
                       host, port, user, database_name, str(password is None))
-            self.db.bind(provider='mysql', host=host, port=int(port), user=user, passwd=password, db=database_name)
+            self.db.bind(provider='mysql', host=host, port=int(port), user=user, passwd=password, db=database_name,
+                         **options)
         elif provider == 'postgres':
             LOG.info('Starting persistence layer using PostgreSQL on %s:%s db: %s', host, port, database_name)
             LOG.debug('PostgreSQL data: host --> %s, port --> %s, user --> %s, db --> %s, password empty --> %s',
                       host, user, port, database_name, str(password is None))
             self.db.bind(provider='postgres', host=host, port=port, user=user, password=password,
-                         database=database_name)
+                         database=database_name, **options)
         elif filename is not None:
                 LOG.info('Starting persistence layer on file %s using SQLite.', filename)
-                self.db.bind(provider='sqlite', filename=filename, create_db=create)
+                self.db.bind(provider='sqlite', filename=filename, create_db=create, **options)
         else:
             LOG.info('Starting persistence layer on memory using SQLite.')
-            self.db.bind(provider='sqlite', filename=':memory:')
-        self.db.generate_mapping(create_tables=True)
+            self.db.bind(provider='sqlite', filename=':memory:', **options)
+        # Tables are checked once columns added since they were created exist.
+        self.db.generate_mapping(create_tables=True, check_tables=False)
+        schema.upgrade(self.db)
+        self.db.check_tables()
+
+    @db_session
+    def ping(self):
+        """Checks the connection of the calling thread, reconnecting if the server dropped it."""
+        return self.db.select('SELECT 1')[0] == 1
 
     @db_session
     def get_sounds(self, include_disabled=True):
@@ -69,7 +139,7 @@ class Database:
             query = self.db.Sound.select(lambda sound: sound.disabled is False)
         sounds = [Sound(db_object)
                   for db_object in query]
-        LOG.debug("get_sounds: Obtained %d: %s", len(sounds), str(sounds))
+        LOG.debug("get_sounds: Obtained %d: %s", len(sounds), sounds)
         return sounds
 
     @db_session
@@ -90,10 +160,98 @@ class Database:
         self.db.Sound(id=id, filename=filename, text=text, tags=tags, disabled=disabled)
         commit()
 
+    @db_session
+    def sync_sounds(self, json_sounds):
+        """Makes the enabled sounds match json_sounds in a single transaction.
+
+        New filenames are inserted, changed texts or tags are updated, known sounds are enabled again
+        and sounds missing from json_sounds are disabled. Returns the enabled sounds, in json_sounds
+        order, and a SyncReport with the filenames of each kind of change.
+        """
+        # Compared as plain rows, which is much faster than loading every sound through the ORM.
+        quote = self.db.provider.quote_name
+        rows = self.db.select('SELECT {} FROM {}'.format(', '.join(quote(column) for column in _SoundRow._fields),
+                                                        quote(self.db.Sound._table_)))
+        db_sounds = {row[1]: _SoundRow(row[0], row[1], row[2], row[3], bool(row[4]), row[5], row[6]) for row in rows}
+        used_ids = {db_sound.id for db_sound in db_sounds.values()}
+        report = SyncReport([], [], [])
+        enabled = []
+        inserted = []
+        updated = []
+        for jsound in json_sounds:
+            filename = jsound["filename"]
+            db_sound = db_sounds.get(filename)
+            if db_sound is None:
+                db_sound = _SoundRow(_new_sound_id(used_ids), filename, jsound["text"], jsound["tags"], False, '', '')
+                db_sounds[filename] = db_sound
+                inserted.append(db_sound)
+                report.added.append(filename)
+            elif (db_sound.text, db_sound.tags, db_sound.disabled) != (jsound["text"], jsound["tags"], False):
+                db_sound = db_sound._replace(text=jsound["text"], tags=jsound["tags"], disabled=False)
+                db_sounds[filename] = db_sound
+                updated.append(db_sound)
+                report.updated.append(filename)
+            enabled.append(db_sound)
+        wanted = {jsound["filename"] for jsound in json_sounds}
+        disabled = [db_sound for filename, db_sound in db_sounds.items()
+                    if filename not in wanted and not db_sound.disabled]
+        report.disabled.extend(db_sound.filename for db_sound in disabled)
+        self._write_sounds(inserted, updated, disabled)
+        commit()
+        LOG.info('Synchronized sounds: %d added, %d updated, %d disabled.',
+                 len(report.added), len(report.updated), len(report.disabled))
+        return [Sound(db_sound) for db_sound in enabled], report
+
+    def _write_sounds(self, inserted, updated, disabled):
+        # Rows are written with one statement per kind of change rather than through the ORM, so
+        # synchronizing a catalogue costs as much as its changes, not as much as its size.
+        provider = self.db.provider
+        quote = provider.quote_name
+        mark = '?' if provider.paramstyle == 'qmark' else '%s'
+        table = quote(self.db.Sound._table_)
+        cursor = self.db.get_connection().cursor()
+        if inserted:
+            columns = _SoundRow._fields
+            cursor.executemany('INSERT INTO {} ({}) VALUES ({})'.format(
+                table, ', '.join(quote(column) for column in columns), ', '.join([mark] * len(columns))),
+                [tuple(db_sound) for db_sound in inserted])
+        if updated:
+            cursor.executemany('UPDATE {} SET {} = {m}, {} = {m}, {} = {m} WHERE {} = {m}'.format(
+                table, quote('text'), quote('tags'), quote('disabled'), quote('id'), m=mark),
+                [(db_sound.text, db_sound.tags, False, db_sound.id) for db_sound in updated])
+        if disabled:
+            cursor.executemany('UPDATE {} SET {} = {m} WHERE {} = {m}'.format(
+                table, quote('disabled'), quote('id'), m=mark),
+                [(True, db_sound.id) for db_sound in disabled])
+
+    @db_session
+    def set_sound_media(self, sound_id, content_hash, file_id):
+        """Stores the Telegram file_id of the upload of the sound file with the given content hash."""
+        db_sound = self.db.Sound.get(id=sound_id)
+        if db_sound is None:
+            LOG.warning('Discarding file_id of unknown sound %s', sound_id)
+            return
+        db_sound.set(content_hash=content_hash, file_id=file_id)
+
+    @db_session
+    def get_popularity(self):
+        """Saved popularity scores as (sound id, language, score, time of the score)."""
+        return select((p.sound.id, p.language, p.score, p.updated) for p in self.db.SoundPopularity)[:]
+
+    @db_session
+    def save_popularity(self, scores, updated):
+        """Replaces the saved popularity scores with scores, (sound id, language, score) as of updated."""
+        sound_ids = set(select(s.id for s in self.db.Sound))
+        delete(p for p in self.db.SoundPopularity)
+        for sound_id, language, score in scores:
+            if sound_id in sound_ids:
+                self.db.SoundPopularity(sound=sound_id, language=language, score=score, updated=updated)
+        commit()
+
     @db_session
     def delete_sound(self, sound):
         assert type(sound) is Sound
-        LOG.info('Deleting sound %s', str(sound))
+        LOG.info('Deleting sound %s', sound)
         sound = self.db.Sound.get(filename=sound.filename)
         if len(sound.uses) > 0:
             sound.delete()
@@ -102,7 +260,7 @@ class Database:
 
     @db_session
     def add_user(self, id, is_bot, first_name, last_name, username, language_code, queries, results, first_seen):
-        LOG.info("Adding user {} {} (@{}) - {}".format(first_name, last_name, username, first_seen))
+        LOG.info("Adding user %s %s (@%s) - %s", first_name, last_name, username, first_seen)
         self.db.User(id=id,
                      is_bot=is_bot,
                      first_name=first_name,
@@ -115,36 +273,22 @@ class Database:
 
     @db_session
     def add_or_update_user(self, user):
-        if not isinstance(user, dict):
-            user = vars(user)
-            LOG.debug('Translated type: %s', str(user))
-        db_user = self.get_user(id=user['id'])
-        if db_user is not None and user != db_user:
-            LOG.info('Updating user: %s', str(db_user))
-            updated_user = self.db.User[user['id']]
-            updated_user.id = user['id']
-            updated_user.is_bot = user['is_bot']
-            updated_user.first_name = user['first_name']
-            updated_user.last_name = (user['last_name'] if user['last_name'] is not None else '')
-            updated_user.username = (user['username'] if user['username'] is not None else '')
-            updated_user.language_code = (user['language_code'] if user['language_code'] is not None else '')
-        elif db_user is None:
-            LOG.info('Adding user: %s', str(user))
-            self.db.User(id=user['id'], is_bot=user['is_bot'], first_name=user['first_name'],
-                         last_name=(user['last_name'] if user['last_name'] is not None else ''),
-                         username=(user['username'] if user['username'] is not None else ''),
-                         language_code=(user['language_code'] if user['language_code'] is not None else ''))
-        else:
-            LOG.debug('User %s already in database.', user['id'])
+        """Adds or updates user, a dict or a Telegram user, and returns it when it was written."""
+        profile = _profile(user)
+        if self.user_cache.is_current(profile):
+            LOG.debug('User %s already in database.', profile['id'])
             return
+        db_user = self._save_user(profile)
         commit()
-        return self.get_user(user['id'])
+        self.user_cache.store([profile])
+        if db_user is not None:
+            return object_to_user(db_user)
 
     @db_session
     def get_users(self):
         query = self.db.User.select()
         users = query[:]
-        LOG.debug("get_users: Obtained %d: %s", len(users), str(users))
+        LOG.debug("get_users: Obtained %d: %s", len(users), users)
         return users
 
     @db_session
@@ -161,18 +305,29 @@ class Database:
 
     @db_session
     def add_raw_query(self, id, user, text, timestamp):
-        LOG.info("Adding query: {} - {} ({})".format(user, text, timestamp))
+        LOG.debug("Adding query: %s - %s (%s)", user, text, timestamp)
         self.db.QueryHistory(id=id, user=self.db.User[user.id], text=text, timestamp=timestamp)
 
     @db_session
     def add_query(self, query):
-        LOG.info("Adding query: %s", str(query))
-        from_user = query.from_user
-        db_user = self.get_user(from_user.id)
-        if not db_user:
-            db_user = self.add_or_update_user(from_user)
+        LOG.debug("Adding query: %s", query)
+        saved_users = []
+        self.db.QueryHistory(user=self._get_or_add_user(query.from_user, saved_users), text=query.query)
+        commit()
+        self.user_cache.store(saved_users)
+
+    @db_session
+    def add_queries(self, queries):
+        """Stores a batch of (from_user, text, timestamp, collapsed) queries in a single transaction."""
+        saved_users = []
+        self._add_queries(queries, saved_users)
+        commit()
+        self.user_cache.store(saved_users)
 
-        self.db.QueryHistory(user=self.db.User[db_user['id']], text=query.query)
+    def _add_queries(self, queries, saved_users):
+        for from_user, text, timestamp, collapsed in queries:
+            self.db.QueryHistory(user=self._get_or_add_user(from_user, saved_users), text=text, timestamp=timestamp,
+                                 collapsed=collapsed)
 
     @db_session
     def get_query(self, id):
@@ -182,23 +337,82 @@ class Database:
     def get_queries(self):
         query = self.db.QueryHistory.select()
         queries = query[:]
-        LOG.debug("get_queries: Obtained %d: %s", len(queries), str(queries))
+        LOG.debug("get_queries: Obtained %d: %s", len(queries), queries)
         return queries
 
     @db_session
     def add_raw_result(self, id, user, sound, timestamp):
-        LOG.info("Adding result: {} - {} ({})".format(user, sound, timestamp))
+        LOG.debug("Adding result: %s - %s (%s)", user, sound, timestamp)
         self.db.ResultHistory(id=id, user=self.db.User[user.id], sound=self.db.Sound[sound.id], timestamp=timestamp)
 
     @db_session
     def add_result(self, result):
-        LOG.info("Adding result: %s", str(result))
-        from_user = result.from_user
-        db_user = self.get_user(from_user.id)
-        if not db_user:
-            db_user = self.add_or_update_user(from_user)
+        LOG.debug("Adding result: %s", result)
+        saved_users = []
+        user = self._get_or_add_user(result.from_user, saved_users)
+        sound = self.db.Sound[result.result_id]
+        timestamp = datetime.datetime.now()
+        self.db.ResultHistory(user=user, sound=sound, timestamp=timestamp)
+        self._touch_recent_sound(user, sound, timestamp)
+        commit()
+        self.user_cache.store(saved_users)
+
+    @db_session
+    def add_results(self, results):
+        """Stores a batch of (from_user, sound_id, timestamp) results in a single transaction."""
+        saved_users = []
+        self._add_results(results, saved_users)
+        commit()
+        self.user_cache.store(saved_users)
 
-        self.db.ResultHistory(user=self.db.User[db_user['id']], sound=self.db.Sound[result.result_id])
+    @db_session
+    def add_history(self, queries, results):
+        """Stores a batch of queries, as in add_queries(), and of results, as in add_results(), in a
+        single transaction."""
+        saved_users = []
+        self._add_queries(queries, saved_users)
+        self._add_results(results, saved_users)
+        commit()
+        self.user_cache.store(saved_users)
+
+    def _add_results(self, results, saved_users):
+        for from_user, sound_id, timestamp in results:
+            sound = self.db.Sound.get(id=int(sound_id))
+            if not sound:
+                LOG.warning('Discarding result of unknown sound %s', sound_id)
+                continue
+            user = self._get_or_add_user(from_user, saved_users)
+            self.db.ResultHistory(user=user, sound=sound, timestamp=timestamp)
+            self._touch_recent_sound(user, sound, timestamp)
+
+    def _touch_recent_sound(self, user, sound, timestamp):
+        recent = self.db.UserRecentSound.get(user=user, sound=sound)
+        if recent is None:
+            self.db.UserRecentSound(user=user, sound=sound, last_used=timestamp)
+        elif recent.last_used < timestamp:
+            recent.last_used = timestamp
+
+    def _get_or_add_user(self, from_user, saved_users):
+        """Returns the id of from_user, writing its profile unless the user cache knows it.
+
+        Written profiles are appended to saved_users, to be cached once the transaction commits.
+        """
+        profile = user_to_dict(from_user)
+        if not self.user_cache.is_current(profile):
+            self._save_user(profile)
+            saved_users.append(profile)
+        return profile['id']
+
+    def _save_user(self, profile):
+        """Adds or updates the user of profile, returns it unless the database already had it."""
+        db_user = self.db.User.get(id=profile['id'])
+        if db_user is None:
+            LOG.info('Adding user: %s', profile)
+            return self.db.User(id=profile['id'], **_user_columns(profile))
+        if object_to_user(db_user) != profile:
+            LOG.info('Updating user: %s', profile)
+            db_user.set(**_user_columns(profile))
+            return db_user
 
     @db_session
     def get_result(self, id):
@@ -208,29 +422,16 @@ class Database:
     def get_results(self):
         query = self.db.ResultHistory.select()
         results = query[:]
-        LOG.debug("get_results: Obtained %d: %s", len(results), str(results))
+        LOG.debug("get_results: Obtained %d: %s", len(results), results)
         return results
 
     @db_session
     def get_latest_used_sounds_from_user(self, user_id, limit=3):
-        user = self.db.User.get(id=user_id)
-        if user:
-            results = self.db.Sound.select_by_sql('SELECT sound.* '
-                                                  'FROM sound, resulthistory '
-                                                  'WHERE sound.id = resulthistory.sound '
-                                                  'AND resulthistory.id IN '
-                                                  '(SELECT MAX(id) '
-                                                  'FROM resulthistory '
-                                                  'WHERE resulthistory.user = $user '
-                                                  'GROUP BY resulthistory.sound) '
-                                                  'ORDER BY resulthistory.id DESC '
-                                                  'LIMIT $limit;',
-                                                  globals={'user': user.id, 'limit': limit})
-            LOG.debug("Obtained %d latest used sound results.", len(results))
-            return [Sound(db_object)
-                    for db_object in results]
-        else:
-            return []
+        recent_sounds = select(r for r in self.db.UserRecentSound if r.user.id == user_id) \
+            .order_by(desc(self.db.UserRecentSound.last_used)).prefetch(self.db.Sound)[:limit]
+        LOG.debug("Obtained %d latest used sound results.", len(recent_sounds))
+        return [Sound(recent.sound)
+                for recent in recent_sounds]
 
 
 class Sound:
@@ -240,6 +441,8 @@ class Sound:
         self.text = db_object.text
         self.tags = db_object.tags
         self.disabled = db_object.disabled
+        self.file_id = db_object.file_id or None
+        self.content_hash = db_object.content_hash or None
 
     def __repr__(self):
         return f"Sound({self.id} {self.filename})"
@@ -253,48 +456,24 @@ class Sound:
                 self.id == other.id)
 
 
-def migrate(from_db, to_db):
-    sounds = from_db.get_sounds()
-    users = from_db.get_users()
-    queries = from_db.get_queries()
-    results = from_db.get_results()
-    LOG.info("Migrating %d sounds, %d users, %d queries, %d results.",
-             len(sounds), len(users), len(queries), len(results))
-    for sound in sounds:
-        if to_db.get_sound(sound.id):
-            continue
-        to_db.add_sound(sound.id,
-                        sound.filename,
-                        sound.text,
-                        sound.tags,
-                        sound.disabled)
-    for user in users:
-        if to_db.get_user(user.id):
-            continue
-        to_db.add_user(user.id,
-                       user.is_bot,
-                       user.first_name,
-                       user.last_name,
-                       user.username,
-                       user.language_code,
-                       user.queries,
-                       user.results,
-                       user.first_seen)
-    for query in queries:
-        if to_db.get_query(query.id):
-            continue
-        to_db.add_raw_query(query.id,
-                            query.user,
-                            query.text,
-                            query.timestamp)
-    for result in results:
-        if to_db.get_result(result.id):
-            continue
-        to_db.add_raw_result(result.id,
-                             result.user,
-                             result.sound,
-                             result.timestamp)
-    LOG.info("Migration finished.")
+def _new_sound_id(used_ids):
+    while True:
+        id = random.randrange(10 ** 8)
+        if id not in used_ids:
+            used_ids.add(id)
+            return id
+
+
+DB_CALL_SECONDS = metrics.histogram('quakesounds_db_call_seconds', 'Duration of Database method calls.', ['method'])
+DB_CALL_ERRORS = metrics.counter('quakesounds_db_call_errors_total', 'Database method calls that raised.', ['method'])
+
+for _name, _method in list(vars(Database).items()):
+    if not _name.startswith('_') and callable(_method):
+        setattr(Database, _name, metrics.timed(DB_CALL_SECONDS, _name, errors=DB_CALL_ERRORS)(_method))
+
+
+def migrate(from_db, to_db, chunk_size=1000, checkpoint_path=None):
+    Migrator(from_db, to_db, chunk_size=chunk_size, checkpoint_path=checkpoint_path).run()
 
 # MAPPERS
 
@@ -310,6 +489,26 @@ def object_to_user(db_object):
             'language_code': (db_object.language_code if db_object.language_code is not '' else None)}
 
 
+def _profile(user):
+    if isinstance(user, dict):
+        return {field: user[field] for field in ('id', 'is_bot', 'first_name', 'username', 'last_name',
+                                                 'language_code')}
+    return user_to_dict(user)
+
+
+def _user_columns(profile):
+    # Missing optional names are stored as empty strings.
+    return {'is_bot': profile['is_bot'], 'first_name': profile['first_name'],
+            'last_name': profile['last_name'] if profile['last_name'] is not None else '',
+            'username': profile['username'] if profile['username'] is not None else '',
+            'language_code': profile['language_code'] if profile['language_code'] is not None else ''}
+
+
+def user_to_dict(user):
+    return {'id': user.id, 'is_bot': user.is_bot, 'first_name': user.first_name, 'username': user.username,
+            'last_name': user.last_name, 'language_code': user.language_code}
+
+
 def object_to_query(db_object):
     return {'id': db_object.id, 'user': object_to_user(db_object.user), 'text': db_object.text,
             'timestamp': db_object.timestamp}
@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RecentSoundsCache:
+    """Bounded LRU cache of the latest sounds used by each user.
+
+    Entries are loaded from the database on a miss and kept up to date with record(), so the
+    empty query path only hits the database the first time a user shows up since startup. Sounds
+    recorded for a user who is not cached are kept aside and merged with the next database read,
+    which may not include them yet when results are written behind or by another process.
+    """
+
+    def __init__(self, database, capacity=10000, limit=3):
+        self.database = database
+        self.capacity = capacity
+        self.limit = limit
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id):
+        with self._lock:
+            sounds = self._entries.get(user_id)
+            if sounds is not None:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return list(sounds)
+            self.misses += 1
+        sounds = self.database.get_latest_used_sounds_from_user(user_id, limit=self.limit)
+        with self._lock:
+            # Results recorded before or while the database was being read are newer than it.
+            sounds = self._entries.get(user_id) or self._merge(self._pending.pop(user_id, []), sounds)
+            self._store(user_id, sounds)
+        return list(sounds)
+
+    def record(self, user_id, sound):
+        """Moves sound to the front of the recent sounds of user_id."""
+        with self._lock:
+            sounds = self._entries.get(user_id)
+            if sounds is not None:
+                self._store(user_id, self._merge([sound], sounds))
+                return
+            self._pending[user_id] = self._merge([sound], self._pending.get(user_id, []))
+            self._pending.move_to_end(user_id)
+            while len(self._pending) > self.capacity:
+                self._pending.popitem(last=False)
+
+    def _merge(self, newer, older):
+        return (newer + [s for s in older if s not in newer])[:self.limit]
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._pending.clear()
+            else:
+                self._entries.pop(user_id, None)
+                self._pending.pop(user_id, None)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _store(self, user_id, sounds):
+        self._entries[user_id] = sounds
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+
+class UserCache:
+    """Bounded LRU cache of the profiles of users known to be stored in the database.
+
+    Only a hash of the profile is kept for every user id, which is enough to tell whether a user
+    seen in an update is new or changed. Entries expire after ttl seconds, so that profiles
+    written by another process are eventually checked against the database again.
+    """
+
+    def __init__(self, capacity=100000, ttl=3600.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_current(self, profile):
+        """Whether profile is the one last stored for its user, and not too long ago."""
+        with self._lock:
+            entry = self._entries.get(profile['id'])
+            if entry is not None and entry[0] == _profile_hash(profile) and entry[1] > time.monotonic():
+                self._entries.move_to_end(profile['id'])
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def store(self, profiles):
+        """Remembers profiles as stored in the database. Only call it once they are committed."""
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for profile in profiles:
+                self._entries[profile['id']] = (_profile_hash(profile), expires)
+                self._entries.move_to_end(profile['id'])
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def _profile_hash(profile):
+    return hash(tuple(sorted(profile.items())))
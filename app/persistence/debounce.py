@@ -0,0 +1,65 @@
+import datetime
+import threading
+import time
+
+
+class QueryCoalescer:
+    """Keeps only the last inline query of each typing burst.
+
+    Telegram sends a query per keystroke. Queries of a user are held back until the user has been
+    idle for idle_window seconds, or chooses a result, and only the last one is passed to
+    sink.add_query along with how many queries it stands for.
+    """
+
+    def __init__(self, sink, idle_window=2.0):
+        self.sink = sink
+        self.idle_window = idle_window
+        self.collapsed = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='query-coalescer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the flushing thread and passes on every pending query."""
+        self._stopping.set()
+        self.flush()
+
+    def pending(self):
+        return len(self._pending)
+
+    def add_query(self, query):
+        now = time.monotonic()
+        with self._lock:
+            pending = self._pending.get(query.from_user.id)
+            queries = pending[1] + 1 if pending else 1
+            self._pending[query.from_user.id] = (query, queries, datetime.datetime.now(), now)
+
+    def flush(self, user_id=None):
+        """Passes on the pending query of user_id, or of every user."""
+        with self._lock:
+            if user_id is None:
+                flushed = list(self._pending.values())
+                self._pending.clear()
+            else:
+                pending = self._pending.pop(user_id, None)
+                flushed = [pending] if pending else []
+        self._emit(flushed)
+
+    def _run(self):
+        while not self._stopping.wait(self.idle_window / 2):
+            deadline = time.monotonic() - self.idle_window
+            with self._lock:
+                idle = [user_id for user_id, (_, _, _, last_seen) in self._pending.items() if last_seen <= deadline]
+                flushed = [self._pending.pop(user_id) for user_id in idle]
+            self._emit(flushed)
+
+    def _emit(self, flushed):
+        with self._lock:
+            self.collapsed += sum(queries - 1 for _, queries, _, _ in flushed)
+        for query, queries, timestamp, _ in flushed:
+            self.sink.add_query(query, collapsed=queries, timestamp=timestamp)
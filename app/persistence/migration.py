@@ -0,0 +1,117 @@
+import json
+import os
+import time
+from pony.orm import db_session, raw_sql
+import logger
+
+# Migrated entities, in dependency order, with their primary key and the attributes copied for each of
+# them, primary key first.
+TABLES = (('Sound', ('id',), ('id', 'filename', 'text', 'tags', 'disabled', 'file_id', 'content_hash')),
+          ('User', ('id',), ('id', 'is_bot', 'first_name', 'last_name', 'username', 'language_code', 'first_seen')),
+          ('QueryHistory', ('id',), ('id', 'user', 'text', 'timestamp', 'collapsed')),
+          ('ResultHistory', ('id',), ('id', 'user', 'sound', 'timestamp')),
+          ('UserRecentSound', ('user', 'sound'), ('user', 'sound', 'last_used')),
+          ('RollupDay', ('day',), ('day', 'purged')),
+          ('DailySoundUse', ('day', 'sound'), ('day', 'sound', 'uses')),
+          ('DailyUserActivity', ('day', 'user'), ('day', 'user', 'queries', 'results', 'keystrokes')),
+          ('DailyQuery', ('id',), ('id', 'day', 'text', 'queries')),
+          ('SoundPopularity', ('sound', 'language'), ('sound', 'language', 'score', 'updated')))
+
+
+class Migrator:
+    """Copies every table of a database into another one, a chunk of rows at a time.
+
+    Source rows are read in primary key order with keyset pagination and each chunk is written in its
+    own transaction, so memory use does not depend on table sizes. The last copied key of every table
+    is saved to checkpoint_path after each chunk, which lets an interrupted migration resume where it
+    stopped. Rows already present in the destination are skipped.
+    """
+
+    def __init__(self, from_db, to_db, chunk_size=1000, checkpoint_path=None):
+        global LOG
+        LOG = logger.get_logger('persistence.migration')
+        self.from_db = from_db
+        self.to_db = to_db
+        self.chunk_size = chunk_size
+        self.checkpoint_path = checkpoint_path
+
+    def run(self):
+        checkpoint = self._load_checkpoint()
+        for table, key, attributes in TABLES:
+            copied = 0
+            start = time.monotonic()
+            while True:
+                rows = self._read_chunk(table, key, attributes, checkpoint.get(table))
+                if not rows:
+                    break
+                copied += self._write_chunk(table, key, attributes, rows)
+                last = rows[-1][:len(key)]
+                checkpoint[table] = last[0] if len(key) == 1 else list(last)
+                self._save_checkpoint(checkpoint)
+                LOG.debug('%s: migrated up to key %s.', table, checkpoint[table])
+            elapsed = time.monotonic() - start
+            LOG.info('%s: migrated %d rows in %.1fs (%.0f rows/s).',
+                     table, copied, elapsed, copied / elapsed if elapsed else 0)
+        LOG.info("Migration finished.")
+
+    def _read_chunk(self, table, key, attributes, last):
+        with db_session:
+            entity = self.from_db.db.entities[table]
+            query = entity.select()
+            if last is not None:
+                last = [last] if len(key) == 1 else last
+                condition = _compare(self.from_db.db, entity, key, '>', 'last')
+                query = entity.select(lambda e: raw_sql(condition))
+            return [tuple(_raw_value(getattr(db_object, attribute)) for attribute in attributes)
+                    for db_object in query.order_by(*(getattr(entity, attribute) for attribute in key))
+                    [:self.chunk_size]]
+
+    def _write_chunk(self, table, key, attributes, rows):
+        with db_session:
+            entity = self.to_db.db.entities[table]
+            first = rows[0][:len(key)]
+            last = rows[-1][:len(key)]
+            # Rows between the first and the last key of the chunk, in the same order as the source.
+            condition = 'NOT ({}) AND NOT ({})'.format(_compare(self.to_db.db, entity, key, '<', 'first'),
+                                                       _compare(self.to_db.db, entity, key, '>', 'last'))
+            existing = {tuple(_raw_value(getattr(db_object, attribute)) for attribute in key)
+                        for db_object in entity.select(lambda e: raw_sql(condition))}
+            missing = [row for row in rows if row[:len(key)] not in existing]
+            for row in missing:
+                entity(**dict(zip(attributes, row)))
+        return len(missing)
+
+    def _load_checkpoint(self):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        LOG.info('Resuming migration from %s: %s', self.checkpoint_path, checkpoint)
+        return checkpoint
+
+    def _save_checkpoint(self, checkpoint):
+        if not self.checkpoint_path:
+            return
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            # Dates of composite keys are saved as ISO strings, which compare like them in SQL.
+            json.dump(checkpoint, checkpoint_file, default=str)
+        os.replace(tmp_path, self.checkpoint_path)
+
+
+def _raw_value(value):
+    # Related entities are copied as their primary key, which avoids loading them.
+    get_pk = getattr(value, 'get_pk', None)
+    return get_pk() if get_pk is not None else value
+
+
+def _compare(db, entity, key, operator, name):
+    """SQL comparing the key of entity e with the values of the list variable name, in key order."""
+    quote = db.provider.quote_name
+    columns = ['{}.{}'.format(quote('e'), quote(column)) for attribute in key
+               for column in getattr(entity, attribute).columns]
+    terms = []
+    for i, column in enumerate(columns):
+        terms.append(' AND '.join(['{} = $({}[{}])'.format(columns[j], name, j) for j in range(i)] +
+                                  ['{} {} $({}[{}])'.format(column, operator, name, i)]))
+    return ' OR '.join('({})'.format(term) for term in terms)
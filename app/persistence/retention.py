@@ -0,0 +1,144 @@
+import datetime
+import gzip
+import json
+import os
+import threading
+from pony.orm import db_session, select, count, sum as db_sum, min as db_min
+import logger
+
+
+class Retention:
+    """Rolls history older than keep_days up into daily aggregates and then removes the raw rows.
+
+    Every day is rolled up in a single transaction that also records it in RollupDay, so a day is
+    never counted twice. Raw rows of rolled up days are then deleted in transactions of at most
+    batch_size rows, after being appended to gzipped JSON lines files in archive_dir if one is set.
+    An interrupted run simply continues purging on the next one.
+    """
+
+    def __init__(self, database, keep_days=30, batch_size=5000, archive_dir=None):
+        global LOG
+        LOG = logger.get_logger('persistence.retention')
+        if keep_days < 1:
+            raise ValueError('Raw history must be kept for at least a day, got %s' % keep_days)
+        self.database = database
+        self.db = database.db
+        self.keep_days = keep_days
+        self.batch_size = batch_size
+        self.archive_dir = archive_dir
+        self._stopping = threading.Event()
+
+    def run(self):
+        self.database.ping()
+        cutoff = datetime.date.today() - datetime.timedelta(days=self.keep_days)
+        rolled_up = 0
+        for day in self._days_to_roll_up(cutoff):
+            self._roll_up(day)
+            rolled_up += 1
+        purged = 0
+        for day in self._days_to_purge():
+            purged += self._purge(day)
+        LOG.info('Retention: rolled up %d days and purged %d rows older than %s.', rolled_up, purged, cutoff)
+        return rolled_up, purged
+
+    def start(self, interval):
+        """Runs the retention now and then every interval seconds from a background thread."""
+        def loop():
+            while True:
+                try:
+                    self.run()
+                except Exception as e:
+                    LOG.error('Retention failed: %s', e)
+                if self._stopping.wait(interval):
+                    return
+        threading.Thread(target=loop, name='retention', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+
+    @db_session
+    def _days_to_roll_up(self, cutoff):
+        oldest = [timestamp for timestamp in (db_min(q.timestamp for q in self.db.QueryHistory),
+                                              db_min(r.timestamp for r in self.db.ResultHistory))
+                  if timestamp is not None]
+        if not oldest:
+            return []
+        done = set(select(d.day for d in self.db.RollupDay))
+        day = min(oldest).date()
+        days = []
+        while day < cutoff:
+            if day not in done:
+                days.append(day)
+            day += datetime.timedelta(days=1)
+        return days
+
+    @db_session
+    def _days_to_purge(self):
+        return select(d.day for d in self.db.RollupDay if not d.purged).order_by(1)[:]
+
+    @db_session
+    def _roll_up(self, day):
+        start, end = _bounds(day)
+        uses = select((r.sound, count(r)) for r in self.db.ResultHistory
+                      if r.timestamp >= start and r.timestamp < end)[:]
+        for sound, sound_uses in uses:
+            self.db.DailySoundUse(day=day, sound=sound, uses=sound_uses)
+
+        activity = {}
+        for user, queries, keystrokes in select((q.user, count(q), db_sum(q.collapsed)) for q in self.db.QueryHistory
+                                                if q.timestamp >= start and q.timestamp < end):
+            activity[user] = [queries, 0, keystrokes]
+        for user, results in select((r.user, count(r)) for r in self.db.ResultHistory
+                                    if r.timestamp >= start and r.timestamp < end):
+            activity.setdefault(user, [0, 0, 0])[1] = results
+        for user, (queries, results, keystrokes) in activity.items():
+            self.db.DailyUserActivity(day=day, user=user, queries=queries, results=results, keystrokes=keystrokes)
+
+        texts = {}
+        for text, queries in select((q.text, count(q)) for q in self.db.QueryHistory
+                                    if q.timestamp >= start and q.timestamp < end and q.text != ''):
+            text = text[:255]
+            texts[text] = texts.get(text, 0) + queries
+        for text, queries in texts.items():
+            self.db.DailyQuery(day=day, text=text, queries=queries)
+
+        self.db.RollupDay(day=day, purged=False)
+        LOG.info('Rolled up %s: %d sounds, %d users, %d query texts.', day, len(uses), len(activity), len(texts))
+
+    def _purge(self, day):
+        start, end = _bounds(day)
+        purged = 0
+        for entity, attributes in ((self.db.QueryHistory, ('id', 'user', 'text', 'timestamp', 'collapsed')),
+                                   (self.db.ResultHistory, ('id', 'user', 'sound', 'timestamp'))):
+            while True:
+                with db_session:
+                    rows = select(e for e in entity if e.timestamp >= start and e.timestamp < end)[:self.batch_size]
+                    if not rows:
+                        break
+                    if self.archive_dir:
+                        self._archive(entity, day, attributes, rows)
+                    ids = [row.id for row in rows]
+                    entity.select(lambda e: e.id in ids).delete(bulk=True)
+                purged += len(rows)
+        with db_session:
+            self.db.RollupDay[day].purged = True
+        LOG.debug('Purged %d raw rows of %s.', purged, day)
+        return purged
+
+    def _archive(self, entity, day, attributes, rows):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, '{}-{}.jsonl.gz'.format(entity.__name__.lower(), day.isoformat()))
+        with gzip.open(path, 'at') as archive:
+            for row in rows:
+                values = {}
+                for attribute in attributes:
+                    value = getattr(row, attribute)
+                    value = value.get_pk() if hasattr(value, 'get_pk') else value
+                    values[attribute] = value.isoformat() if isinstance(value, datetime.datetime) else value
+                archive.write(json.dumps(values) + '\n')
+
+
+def _bounds(day):
+    start = datetime.datetime.combine(day, datetime.time())
+    return start, start + datetime.timedelta(days=1)
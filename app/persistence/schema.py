@@ -0,0 +1,80 @@
+from pony.orm import db_session, count
+import logger
+
+# (entity, index name, columns). Pony only creates indexes along with their tables, so indexes
+# added after a table exists in production databases are created here.
+INDEXES = (('ResultHistory', 'idx_resulthistory_user_sound_id', ('user', 'sound', 'id')),
+           ('ResultHistory', 'idx_resulthistory_timestamp', ('timestamp',)),
+           ('QueryHistory', 'idx_queryhistory_user_id', ('user', 'id')),
+           ('QueryHistory', 'idx_queryhistory_timestamp', ('timestamp',)))
+
+# (entity, column, definition) of columns added to tables that may already exist.
+COLUMNS = (('QueryHistory', 'collapsed', 'INTEGER NOT NULL DEFAULT 1'),
+           ('DailyUserActivity', 'keystrokes', 'INTEGER NOT NULL DEFAULT 0'),
+           ('Sound', 'file_id', "VARCHAR(255) NOT NULL DEFAULT ''"),
+           ('Sound', 'content_hash', "VARCHAR(64) NOT NULL DEFAULT ''"))
+
+
+def upgrade(db):
+    """Brings an existing schema up to date: missing columns and indexes, and backfilled tables."""
+    LOG = logger.get_logger('persistence.schema')
+    with db_session:
+        for entity, column, definition in COLUMNS:
+            table = db.entities[entity]._table_
+            if _column_exists(db, table, column):
+                continue
+            LOG.info('Adding column %s to %s.', column, table)
+            db.execute('ALTER TABLE {table} ADD COLUMN {column} {definition}'.format(
+                table=db.provider.quote_name(table),
+                column=db.provider.quote_name(column),
+                definition=definition))
+        for entity, name, columns in INDEXES:
+            table = db.entities[entity]._table_
+            if _index_exists(db, table, name):
+                continue
+            LOG.info('Creating index %s on %s%s.', name, table, columns)
+            db.execute('CREATE INDEX {name} ON {table} ({columns})'.format(
+                name=db.provider.quote_name(name),
+                table=db.provider.quote_name(table),
+                columns=', '.join(db.provider.quote_name(column) for column in columns)))
+    backfill(db)
+
+
+def backfill(db):
+    """Fills the denormalized UserRecentSound table from ResultHistory when it is still empty."""
+    with db_session:
+        if not count(r for r in db.UserRecentSound) and count(r for r in db.ResultHistory):
+            logger.get_logger('persistence.schema').info('Filling UserRecentSound from ResultHistory.')
+            _backfill_recent_sounds(db)
+
+
+def _column_exists(db, table, column):
+    if db.provider.dialect == 'SQLite':
+        return any(row[1] == column for row in db.execute('PRAGMA table_info({})'.format(db.provider.quote_name(table))))
+    if db.provider.dialect == 'MySQL':
+        return bool(db.select('SELECT column_name FROM information_schema.columns '
+                              'WHERE table_schema = DATABASE() AND table_name = $table AND column_name = $column'))
+    return bool(db.select('SELECT column_name FROM information_schema.columns '
+                          'WHERE table_name = $table AND column_name = $column'))
+
+
+def _index_exists(db, table, name):
+    if db.provider.dialect == 'SQLite':
+        return bool(db.select("SELECT name FROM sqlite_master WHERE type = 'index' AND name = $name"))
+    if db.provider.dialect == 'MySQL':
+        return bool(db.select('SELECT index_name FROM information_schema.statistics '
+                              'WHERE table_schema = DATABASE() AND table_name = $table AND index_name = $name'))
+    return bool(db.select('SELECT indexname FROM pg_indexes WHERE indexname = $name'))
+
+
+def _backfill_recent_sounds(db):
+    quote = db.provider.quote_name
+    db.execute('INSERT INTO {recent} ({user}, {sound}, {last_used}) '
+               'SELECT {user}, {sound}, MAX({timestamp}) '
+               'FROM {results} '
+               'GROUP BY {user}, {sound}'.format(recent=quote(db.UserRecentSound._table_),
+                                                 results=quote(db.ResultHistory._table_),
+                                                 user=quote('user'),
+                                                 sound=quote('sound'),
+                                                 last_used=quote('last_used'),
+                                                 timestamp=quote('timestamp')))
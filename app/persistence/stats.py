@@ -0,0 +1,136 @@
+import datetime
+from pony.orm import db_session, select, count, desc, sum as db_sum, max as db_max
+
+
+class Stats:
+    """Usage statistics computed by the database with aggregate queries.
+
+    Nothing here loads history rows into memory: every method returns a handful of counters or
+    grouped rows. Days already rolled up by retention.Retention are read from the daily rollups
+    and the rest from the raw history, so statistics do not change when raw rows are purged.
+    """
+
+    def __init__(self, database):
+        self.db = database.db
+
+    def _horizon(self):
+        """Start of the first day not rolled up yet, or None when nothing was."""
+        last_day = db_max(d.day for d in self.db.RollupDay)
+        if last_day is None:
+            return None
+        return _start_of(last_day + datetime.timedelta(days=1))
+
+    def _raw_since(self, since=None):
+        horizon = self._horizon()
+        if since is None or (horizon is not None and horizon > since):
+            return horizon
+        return since
+
+    @db_session
+    def totals(self):
+        raw_since = self._raw_since()
+        if raw_since is None:
+            raw_queries = count(q for q in self.db.QueryHistory)
+            raw_keystrokes = db_sum(q.collapsed for q in self.db.QueryHistory)
+            raw_results = count(r for r in self.db.ResultHistory)
+        else:
+            raw_queries = count(q for q in self.db.QueryHistory if q.timestamp >= raw_since)
+            raw_keystrokes = db_sum(q.collapsed for q in self.db.QueryHistory if q.timestamp >= raw_since)
+            raw_results = count(r for r in self.db.ResultHistory if r.timestamp >= raw_since)
+        # Rows rolled up before queries were coalesced have no keystrokes, they count one per query.
+        rolled_up_keystrokes = db_sum(max(a.keystrokes, a.queries) for a in self.db.DailyUserActivity)
+        return {'users': count(u for u in self.db.User),
+                'queries': raw_queries + (db_sum(a.queries for a in self.db.DailyUserActivity) or 0),
+                'keystrokes': (raw_keystrokes or 0) + (rolled_up_keystrokes or 0),
+                'results': raw_results + (db_sum(a.results for a in self.db.DailyUserActivity) or 0)}
+
+    @db_session
+    def sound_uses(self, limit=10, since=None):
+        """Most used sounds as (sound id, text, uses), optionally only counting uses after since."""
+        raw_since = self._raw_since(since)
+        if raw_since is None:
+            raw = select((r.sound.id, r.sound.text, count(r)) for r in self.db.ResultHistory)
+        else:
+            raw = select((r.sound.id, r.sound.text, count(r)) for r in self.db.ResultHistory
+                         if r.timestamp >= raw_since)
+        if since is None:
+            rolled_up = select((u.sound.id, u.sound.text, db_sum(u.uses)) for u in self.db.DailySoundUse)
+        else:
+            since_day = since.date()
+            rolled_up = select((u.sound.id, u.sound.text, db_sum(u.uses)) for u in self.db.DailySoundUse
+                               if u.day >= since_day)
+        # Both sides are grouped by sound, so at most two rows per sound of the catalogue are merged.
+        uses = {}
+        for sound_id, text, sound_uses in list(raw) + list(rolled_up):
+            uses[sound_id, text] = uses.get((sound_id, text), 0) + sound_uses
+        ranking = sorted(uses.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(sound_id, text, sound_uses) for (sound_id, text), sound_uses in ranking]
+
+    @db_session
+    def daily_sound_uses(self):
+        """Uses of every sound per day as (sound id, language code, day, uses).
+
+        Days already rolled up by retention.Retention have no language code, it is None.
+        """
+        raw_since = self._raw_since()
+        if raw_since is None:
+            raw = select((r.sound.id, r.user.language_code, r.timestamp.date(), count(r))
+                         for r in self.db.ResultHistory)
+        else:
+            raw = select((r.sound.id, r.user.language_code, r.timestamp.date(), count(r))
+                         for r in self.db.ResultHistory if r.timestamp >= raw_since)
+        rolled_up = select((u.sound.id, u.day, u.uses) for u in self.db.DailySoundUse)
+        return ([(sound_id, language_code or None, day, uses) for sound_id, language_code, day, uses in raw] +
+                [(sound_id, None, day, uses) for sound_id, day, uses in rolled_up])
+
+    @db_session
+    def active_users(self, since):
+        raw_since = self._raw_since(since)
+        raw_users = select(q.user.id for q in self.db.QueryHistory if q.timestamp >= raw_since).distinct()
+        if raw_since == since:
+            return raw_users.count()
+        since_day = since.date()
+        users = set(raw_users)
+        users.update(select(a.user.id for a in self.db.DailyUserActivity if a.day >= since_day))
+        return len(users)
+
+    @db_session
+    def daily_active_users(self, days=7):
+        """Distinct users with at least one query per day, as (date string, users), oldest first."""
+        since = _days_ago(days)
+        raw_since = self._raw_since(since)
+        since_day = since.date()
+        rows = select((a.day, count(a)) for a in self.db.DailyUserActivity
+                      if a.day >= since_day and a.queries > 0)[:]
+        rows = [(str(day), users) for day, users in rows]
+        rows.extend((str(day), users) for day, users in
+                    self.db.select('SELECT DATE(timestamp), COUNT(DISTINCT {user}) '
+                                   'FROM {queries} '
+                                   'WHERE timestamp >= $raw_since '
+                                   'GROUP BY DATE(timestamp);'.format(
+                                       user=self.db.provider.quote_name('user'),
+                                       queries=self.db.provider.quote_name(self.db.QueryHistory._table_))))
+        return sorted(rows)
+
+    @db_session
+    def top_queries(self, limit=10, days=1):
+        since = _days_ago(days)
+        raw_since = self._raw_since(since)
+        raw_queries = select((q.text, count(q)) for q in self.db.QueryHistory
+                             if q.timestamp >= raw_since and q.text != '')
+        if raw_since == since:
+            return raw_queries.order_by(desc(2))[:limit]
+        queries = dict(raw_queries)
+        since_day = since.date()
+        for text, text_queries in select((d.text, db_sum(d.queries)) for d in self.db.DailyQuery
+                                         if d.day >= since_day):
+            queries[text] = queries.get(text, 0) + text_queries
+        return sorted(queries.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+def _start_of(day):
+    return datetime.datetime.combine(day, datetime.time())
+
+
+def _days_ago(days):
+    return _start_of(datetime.date.today()) - datetime.timedelta(days=days - 1)
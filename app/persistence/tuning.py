@@ -0,0 +1,40 @@
+from collections import namedtuple
+
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+Tuning = namedtuple('Tuning', 'sqlite_journal_mode sqlite_synchronous sqlite_mmap_size sqlite_cached_statements '
+                              'connect_timeout')
+Tuning.__new__.__defaults__ = ('WAL', 'NORMAL', 256 * 1024 * 1024, 256, 10)
+DEFAULT_TUNING = Tuning()
+
+
+def bind_options(provider, tuning):
+    """Extra keyword arguments passed to Pony's bind, and from it to the DB-API connect()."""
+    if provider in ('mysql', 'postgres'):
+        return {'connect_timeout': tuning.connect_timeout}
+    # The sqlite3 module keeps this many prepared statements per connection. Pony talks to MySQL
+    # through pymysql or MySQLdb, which only send SQL text, so there is no equivalent for MySQL:
+    # Pony caches the SQL it generates for every query, but the server parses it on every call.
+    return {'cached_statements': tuning.sqlite_cached_statements}
+
+
+def register(db, tuning):
+    """Registers the SQLite settings applied to every new connection Pony opens for db.
+
+    Pony keeps one connection per thread and reopens it when the server drops it, so these run once
+    per worker thread and again after every reconnection.
+    """
+    if tuning.sqlite_journal_mode not in JOURNAL_MODES:
+        raise ValueError('Invalid SQLite journal mode: %s' % tuning.sqlite_journal_mode)
+    if tuning.sqlite_synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError('Invalid SQLite synchronous mode: %s' % tuning.sqlite_synchronous)
+
+    @db.on_connect(provider='sqlite')
+    def sqlite_pragmas(db, connection):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode = %s' % tuning.sqlite_journal_mode)
+        cursor.execute('PRAGMA synchronous = %s' % tuning.sqlite_synchronous)
+        cursor.execute('PRAGMA mmap_size = %d' % int(tuning.sqlite_mmap_size))
+        # Wait for concurrent writers instead of failing right away with "database is locked".
+        cursor.execute('PRAGMA busy_timeout = %d' % (tuning.connect_timeout * 1000))
@@ -0,0 +1,152 @@
+import datetime
+import queue
+import threading
+import time
+import logger
+
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST)
+
+_QUERY = 'query'
+_RESULT = 'result'
+
+
+class WriteBehindQueue:
+    """Buffers query and result history and writes it to the database from a background thread.
+
+    Handlers only pay for an enqueue. The worker flushes whenever batch_size events are pending or
+    flush_interval seconds have passed since the first pending event. When the queue is full,
+    producers wait up to block_timeout for room and then drop either the oldest queued event or the
+    new one, depending on drop_policy.
+
+    A batch is written in a single transaction. When it fails, it is tried again up to max_retries
+    times, waiting retry_backoff seconds the first time and twice as long every next time, and its
+    events are counted as dropped if the last try fails too. The connection of the worker thread is
+    pinged, and reopened if the server dropped it, before retrying and after ping_interval seconds
+    without writing.
+    """
+
+    def __init__(self, database, max_size=10000, batch_size=200, flush_interval=1.0, drop_policy=DROP_OLDEST,
+                 block_timeout=0.01, max_retries=3, retry_backoff=0.5, ping_interval=60.0):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError('Invalid drop policy: %s' % drop_policy)
+        global LOG
+        LOG = logger.get_logger('persistence.writebehind')
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.drop_policy = drop_policy
+        self.block_timeout = block_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.ping_interval = ping_interval
+        self._last_write = time.monotonic()
+        self.queue = queue.Queue(maxsize=max_size)
+        self.written = 0
+        self.dropped = 0
+        self._counters_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._worker = threading.Thread(target=self._run, name='history-writer', daemon=True)
+
+    def start(self):
+        self._worker.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stops the worker once every queued event has been written."""
+        if not self._worker.is_alive():
+            return
+        LOG.info('Draining %d pending history events.', self.queue.qsize())
+        self._stopping.set()
+        self._worker.join(timeout)
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def add_query(self, query, collapsed=1, timestamp=None):
+        """Queues query, which may stand for a burst of collapsed queries typed up to timestamp."""
+        return self._put((_QUERY, query.from_user, (query.query, collapsed), timestamp or datetime.datetime.now()))
+
+    def add_result(self, result):
+        return self._put((_RESULT, result.from_user, result.result_id, datetime.datetime.now()))
+
+    def _put(self, event):
+        try:
+            self.queue.put(event, timeout=self.block_timeout)
+            return True
+        except queue.Full:
+            pass
+        if self.drop_policy == DROP_OLDEST:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                self._count_dropped()
+            try:
+                self.queue.put_nowait(event)
+                return True
+            except queue.Full:
+                pass
+        self._count_dropped()
+        return False
+
+    def _count_dropped(self, events=1):
+        with self._counters_lock:
+            self.dropped += events
+            dropped = self.dropped
+        if dropped == events or dropped // 1000 != (dropped - events) // 1000:
+            LOG.warning('%d history events dropped so far.', dropped)
+
+    def _run(self):
+        while not (self._stopping.is_set() and self.queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0 or self._stopping.is_set():
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        queries = []
+        results = []
+        for kind, user, payload, timestamp in batch:
+            if kind == _QUERY:
+                text, collapsed = payload
+                queries.append((user, text, timestamp, collapsed))
+            else:
+                results.append((user, payload, timestamp))
+        backoff = self.retry_backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                if attempt or time.monotonic() - self._last_write >= self.ping_interval:
+                    self.database.ping()
+                self.database.add_history(queries, results)
+                self._last_write = time.monotonic()
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    LOG.error("Couldn't save %d history events, dropping them: %s", len(batch), e)
+                    self._count_dropped(len(batch))
+                    return
+                LOG.warning("Couldn't save %d history events, retrying in %.1fs: %s", len(batch), backoff, e)
+                time.sleep(backoff)
+                backoff *= 2
+        with self._counters_lock:
+            self.written += len(batch)
+        LOG.debug('Flushed %d queries and %d results.', len(queries), len(results))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import math
+import threading
+import time
+import logger
+
+# Language of the scores of every user, whatever their language.
+GLOBAL = '*'
+# Weights are rescaled once they grow past this, long before floats lose precision.
+MAX_WEIGHT = 1e12
+
+
+def language(language_code):
+    """Primary language of a Telegram language code, 'pt' for 'pt-br', or GLOBAL when unknown."""
+    if not language_code:
+        return GLOBAL
+    return language_code.split('-', 1)[0].lower()[:16]
+
+
+class Ranking:
+    """Popularity of every sound, globally and per user language, decaying with a half life.
+
+    Instead of decaying every score as time goes by, each use adds a weight that grows with time,
+    e^((t - origin) / tau), so that a use counts half as much as one made half_life_days later.
+    Scores stay comparable with each other without ever being updated, and recording a use is an
+    addition. When weights get too large, scores are scaled down and origin moved to the present.
+
+    Scores live in memory. They are loaded from the SoundPopularity snapshot of the database, or
+    seeded from the result history the first time, and saved back by snapshot().
+    """
+
+    def __init__(self, database, stats, half_life_days=7.0, clock=time.time):
+        global LOG
+        LOG = logger.get_logger('ranking')
+        self.database = database
+        self.stats = stats
+        self.tau = half_life_days * 86400 / math.log(2)
+        self.clock = clock
+        self._origin = clock()
+        self._scores = {GLOBAL: {}}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def _weight(self, timestamp):
+        return math.exp((timestamp - self._origin) / self.tau)
+
+    def _add(self, sound_id, languages, weight):
+        for scores in (self._scores.setdefault(language, {}) for language in languages):
+            scores[sound_id] = scores.get(sound_id, 0.0) + weight
+
+    def load(self):
+        """Loads the saved scores, or computes them from the result history when there are none."""
+        saved = self.database.get_popularity()
+        with self._lock:
+            self._origin = self.clock()
+            self._scores = {GLOBAL: {}}
+            for sound_id, sound_language, score, updated in saved:
+                self._add(sound_id, (sound_language,), score * self._weight(updated.timestamp()))
+        if saved:
+            LOG.info('Loaded popularity of %d sounds.', len(self._scores[GLOBAL]))
+            return self
+        uses = self.stats.daily_sound_uses()
+        with self._lock:
+            for sound_id, language_code, day, day_uses in uses:
+                # Uses of a day are weighted as if they all happened at noon.
+                timestamp = datetime.datetime.combine(day, datetime.time(12)).timestamp()
+                self._add(sound_id, {GLOBAL, language(language_code)}, day_uses * self._weight(timestamp))
+        LOG.info('Computed popularity of %d sounds from %d days of uses.', len(self._scores[GLOBAL]), len(uses))
+        return self
+
+    def record(self, sound_id, language_code, timestamp=None):
+        """Adds a use of sound_id by a user with language_code."""
+        timestamp = self.clock() if timestamp is None else timestamp
+        with self._lock:
+            weight = self._weight(timestamp)
+            if weight > MAX_WEIGHT:
+                self._rescale(timestamp)
+                weight = 1.0
+            self._add(sound_id, {GLOBAL, language(language_code)}, weight)
+
+    def _rescale(self, timestamp):
+        factor = 1 / self._weight(timestamp)
+        for scores in self._scores.values():
+            for sound_id in scores:
+                scores[sound_id] *= factor
+        self._origin = timestamp
+
+    def scores(self, language=GLOBAL):
+        """Scores of language as of now, in uses: a use made now scores 1."""
+        with self._lock:
+            factor = 1 / self._weight(self.clock())
+            return {sound_id: score * factor for sound_id, score in self._scores.get(language, {}).items()}
+
+    def orders(self, sounds):
+        """sounds sorted by global popularity, and by popularity in each language, ties keeping their order.
+
+        Returns a dict from GLOBAL and every language with scores to a list of sounds.
+        """
+        with self._lock:
+            scores = {language: dict(language_scores) for language, language_scores in self._scores.items()}
+        global_scores = scores.pop(GLOBAL)
+        by_global = sorted(sounds, key=lambda sound: -global_scores.get(sound.id, 0.0))
+        orders = {GLOBAL: by_global}
+        for language, language_scores in scores.items():
+            orders[language] = sorted(by_global, key=lambda sound: -language_scores.get(sound.id, 0.0))
+        return orders
+
+    def snapshot(self):
+        """Saves the current scores to the database."""
+        self.database.ping()
+        now = self.clock()
+        with self._lock:
+            factor = 1 / self._weight(now)
+            rows = [(sound_id, language, score * factor)
+                    for language, scores in self._scores.items() for sound_id, score in scores.items()]
+        self.database.save_popularity(rows, datetime.datetime.fromtimestamp(now))
+        LOG.debug('Saved %d popularity scores.', len(rows))
+
+    def start(self, interval, on_snapshot=None):
+        """Saves the scores and calls on_snapshot every interval seconds from a background thread."""
+        def loop():
+            while not self._stopping.wait(interval):
+                try:
+                    self.snapshot()
+                    if on_snapshot is not None:
+                        on_snapshot()
+                except Exception as e:
+                    LOG.error('Ranking snapshot failed: %s', e)
+        threading.Thread(target=loop, name='ranking', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self.snapshot()
@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+import telebot.types as types
+
+RECENT_PREFIX = '🕚 '
+
+
+class SerializedResults(types.JsonSerializable):
+    """Inline query results already serialized to the comma separated JSON objects of an answer."""
+
+    def __init__(self, fragments):
+        self.json_fragment = ','.join(fragments)
+        self.count = len(fragments)
+
+    def to_json(self):
+        return self.json_fragment
+
+    def __len__(self):
+        return self.count
+
+
+class ResultCatalog:
+    """Inline query results of a sound catalogue, serialized once.
+
+    Sounds with a Telegram file_id in file_ids are answered with InlineQueryResultCachedVoice, so
+    Telegram does not fetch them again, and the rest with InlineQueryResultVoice and their URL.
+    The URL of a sound is bucket followed by its entry in paths, or by its filename.
+
+    It also keeps a LRU cache of whole answers keyed by normalized query text. A catalogue is built
+    for a given set of sounds, so replacing it is what invalidates the cache.
+    """
+
+    def __init__(self, sounds, bucket, cache_size=1024, file_ids=None, paths=None):
+        self.bucket = bucket
+        self.cache_size = cache_size
+        self.file_ids = file_ids or {}
+        self.paths = paths or {}
+        self._results = {}
+        self._recent_results = {}
+        for sound in sounds:
+            self._results[sound.id] = self._result(sound, sound.text).to_json()
+            self._recent_results[sound.id] = self._result(sound, RECENT_PREFIX + sound.text).to_json()
+        self.hits = 0
+        self.misses = 0
+        self._answers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _result(self, sound, title):
+        file_id = self.file_ids.get(sound.id)
+        if file_id:
+            return types.InlineQueryResultCachedVoice(sound.id, file_id, title, caption=sound.text)
+        url = self.bucket + self.paths.get(sound.filename, sound.filename)
+        return types.InlineQueryResultVoice(sound.id, url, title, caption=sound.text)
+
+    def answer(self, sounds, recent_sounds=()):
+        """Serialized results for recent_sounds, flagged as recently used, followed by sounds."""
+        fragments = [self._recent_results[sound.id] for sound in recent_sounds if sound.id in self._recent_results]
+        fragments.extend(self._results[sound.id] for sound in sounds if sound.id in self._results)
+        return SerializedResults(fragments)
+
+    def cached_answer(self, key, build):
+        """Answer stored for key, calling build() to create it on a miss."""
+        with self._lock:
+            answer = self._answers.get(key)
+            if answer is not None:
+                self._answers.move_to_end(key)
+                self.hits += 1
+                return answer
+            self.misses += 1
+        answer = build()
+        with self._lock:
+            self._answers[key] = answer
+            while len(self._answers) > self.cache_size:
+                self._answers.popitem(last=False)
+        return answer
@@ -0,0 +1,135 @@
+import heapq
+from itertools import islice
+from normalizer import tokenize
+
+MODE_PREFIX = 'prefix'
+MODE_FUZZY = 'fuzzy'
+MODES = (MODE_PREFIX, MODE_FUZZY)
+
+FUZZY_MIN_LENGTH = 3
+FUZZY_MAX_CANDIDATES = 32
+
+
+def trigrams(token):
+    padded = '$' + token + '$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def max_typos(term):
+    return 1 if len(term) <= 5 else 2
+
+
+def bounded_distance(a, b, bound):
+    """Levenshtein distance between a and b, or bound + 1 as soon as it is known to exceed bound."""
+    if abs(len(a) - len(b)) > bound:
+        return bound + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if min(current) > bound:
+            return bound + 1
+        previous = current
+    return previous[-1]
+
+
+class SearchIndex:
+    """Inverted index over sound texts and tags, built once per catalogue.
+
+    Every sound gets a position given by the order of the catalogue. Postings are sorted by that
+    position so that single term queries can be answered by walking just the head of a list.
+    In fuzzy mode, terms without any prefix match are expanded to the closest words of the
+    vocabulary, found through a trigram index so edit distances are only computed for a few words.
+    """
+
+    def __init__(self, sounds, mode=MODE_PREFIX):
+        if mode not in MODES:
+            raise ValueError('Invalid search mode: %s' % mode)
+        self.mode = mode
+        self.sounds = list(sounds)
+        tokens = {}
+        prefixes = {}
+        for position, sound in enumerate(self.sounds):
+            for token in set(tokenize(sound.text, memoize=False) + tokenize(sound.tags, memoize=False)):
+                tokens.setdefault(token, []).append(position)
+                for i in range(1, len(token) + 1):
+                    prefixes.setdefault(token[:i], set()).add(position)
+        self.tokens = {token: tuple(postings) for token, postings in tokens.items()}
+        self.prefixes = {prefix: tuple(sorted(postings)) for prefix, postings in prefixes.items()}
+        self.trigrams = {}
+        if mode == MODE_FUZZY:
+            for token in self.tokens:
+                for trigram in trigrams(token):
+                    self.trigrams.setdefault(trigram, []).append(token)
+
+    def __len__(self):
+        return len(self.sounds)
+
+    def _exact(self, term):
+        return self.tokens.get(term, ())
+
+    def _prefix(self, term):
+        return self.prefixes.get(term, ())
+
+    def _matches(self, term):
+        postings = self._prefix(term)
+        if postings or self.mode != MODE_FUZZY:
+            return postings
+        return tuple(sorted({position for token in self.similar_tokens(term) for position in self.tokens[token]}))
+
+    def similar_tokens(self, term):
+        """Vocabulary words within a few typos of term, closest first."""
+        if len(term) < FUZZY_MIN_LENGTH:
+            return []
+        shared = {}
+        for trigram in trigrams(term):
+            for token in self.trigrams.get(trigram, ()):
+                shared[token] = shared.get(token, 0) + 1
+        candidates = heapq.nlargest(FUZZY_MAX_CANDIDATES, shared.items(), key=lambda item: item[1])
+        bound = max_typos(term)
+        similar = []
+        for token, _ in candidates:
+            # Compare against the whole word and against its head, so half typed words still match.
+            distance = min(bounded_distance(term, token, bound),
+                           bounded_distance(term, token[:len(term)], bound))
+            if distance <= bound:
+                similar.append((distance, token))
+        return [token for _, token in sorted(similar)]
+
+    def search(self, text, limit):
+        terms = list(dict.fromkeys(tokenize(text)))
+        if not terms:
+            return []
+        if len(terms) == 1:
+            positions = self._search_term(terms[0])
+        else:
+            positions = self._search_terms(terms, limit)
+        return [self.sounds[position] for position in islice(positions, limit)]
+
+    def _search_term(self, term):
+        if not self._prefix(term):
+            yield from self._matches(term)
+            return
+        # Whole word matches rank above prefix matches, ties are broken by catalogue order.
+        exact = self._exact(term)
+        yield from exact
+        exact = set(exact)
+        for position in self._prefix(term):
+            if position not in exact:
+                yield position
+
+    def _search_terms(self, terms, limit):
+        postings = sorted((self._matches(term) for term in terms), key=len)
+        if not postings[0]:
+            return []
+        matches = set(postings[0])
+        for posting in postings[1:]:
+            matches.intersection_update(posting)
+            if not matches:
+                return []
+        exact = [set(self._exact(term)) for term in terms]
+        return heapq.nsmallest(limit, matches,
+                               key=lambda position: (-sum(position in e for e in exact), position))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Serves the sound files from the aiohttp server of the webhook, or from a server of their own.
+
+Every file is served under a URL containing the hash of its content, /sounds/<hash>/<filename>, so
+the content behind a URL never changes and clients and proxies can cache it forever. Files are sent
+with sendfile by web.FileResponse, which also answers Range requests.
+"""
+
+import asyncio
+import os
+import threading
+from aiohttp import hdrs, web
+import logger
+import media
+
+SOUNDS_PATH = '/sounds/'
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+_ROUTE = 'sound'
+
+
+class SoundFiles:
+    """Files of a sound directory along with the hash of their content, computed when refreshed."""
+
+    def __init__(self, directory):
+        global LOG
+        LOG = logger.get_logger('static')
+        self.directory = directory
+        self.hashes = media.FileHashes(directory)
+        self._files = {}
+        self.refresh()
+
+    def refresh(self):
+        """Hashes the files added or changed since the last refresh and returns the number of files."""
+        files = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                file_hash = self.hashes.get(entry.name)
+                if file_hash is not None:
+                    files[entry.name] = file_hash
+        self._files = files
+        LOG.debug('Serving %d sound files from %s', len(files), self.directory)
+        return len(files)
+
+    def get(self, filename):
+        """Content hash of filename, or None when it is not served."""
+        return self._files.get(filename)
+
+    def path(self, filename):
+        return self.hashes.path(filename)
+
+    def paths(self):
+        """Path of every file relative to SOUNDS_PATH."""
+        return {filename: '{}/{}'.format(file_hash, filename) for filename, file_hash in self._files.items()}
+
+
+def add_routes(app, sound_files):
+    """Serves sound_files on SOUNDS_PATH of the aiohttp application app."""
+    async def handle_sound(request):
+        filename = request.match_info['filename']
+        file_hash = sound_files.get(filename)
+        if file_hash is None:
+            raise web.HTTPNotFound()
+        if request.match_info['hash'] != file_hash:
+            # URL of a previous version of the file, from an answer Telegram still has cached.
+            raise web.HTTPFound('{}{}/{}'.format(SOUNDS_PATH, file_hash, filename))
+        headers = {'Cache-Control': CACHE_CONTROL}
+        if request.if_match and not any(etag.value in (file_hash, '*') and not etag.is_weak
+                                        for etag in request.if_match):
+            raise web.HTTPPreconditionFailed()
+        if request.if_none_match and any(etag.value in (file_hash, '*') for etag in request.if_none_match):
+            response = web.Response(status=304, headers=headers)
+            response.etag = file_hash
+            return response
+        # FileResponse would check these against its own ETag, which is not the one clients have.
+        # The date conditions are dropped as well when an ETag condition was checked, as RFC 9110 says.
+        conditions = {hdrs.IF_MATCH, hdrs.IF_NONE_MATCH}
+        if request.if_match:
+            conditions.add(hdrs.IF_UNMODIFIED_SINCE)
+        if request.if_none_match:
+            conditions.add(hdrs.IF_MODIFIED_SINCE)
+        request = request.clone(headers={name: value for name, value in request.headers.items()
+                                         if name not in conditions})
+        response = web.FileResponse(sound_files.path(filename), headers=headers)
+        await response.prepare(request)
+        return response
+
+    async def set_etag(request, response):
+        # FileResponse derives its ETag from the modification time and size of the file. The content
+        # hash is used instead, so the ETag is the same for every worker and every deployment.
+        if request.match_info.route.name == _ROUTE and response.status in (200, 206):
+            response.etag = request.match_info['hash']
+
+    app.router.add_get(SOUNDS_PATH + '{hash}/{filename}', handle_sound, name=_ROUTE)
+    app.on_response_prepare.append(set_etag)
+
+
+def start_server(sound_files, host, port):
+    """Serves sound_files on http://host:port/sounds/ from a daemon thread, when there is no webhook."""
+    app = web.Application()
+    add_routes(app, sound_files)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app)
+    # Bound before returning, so that a port already in use fails here.
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, host, port).start())
+    threading.Thread(target=loop.run_forever, name='sound-server', daemon=True).start()
+    LOG.info('Serving sound files on %s:%d', host, port)
+    return runner
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Serves the webhook from several worker processes sharing one listening socket.
+
+The supervisor binds the socket and starts every worker as a new process of the same command,
+which inherits it and accepts connections from it, so the kernel spreads them among workers. The
+supervisor keeps the single copy of everything that must not run once per worker: setting the
+webhook, synchronizing sounds, uploading media and saving the popularity ranking. It writes the
+catalogue to a snapshot file that workers load, and talks to each of them over a socket pair,
+with one JSON message per line.
+"""
+
+import json
+import os
+import pickle
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import logger
+
+_ENV_LISTEN_FD = 'QUAKESOUNDS_LISTEN_FD'
+_ENV_CHANNEL_FD = 'QUAKESOUNDS_CHANNEL_FD'
+_ENV_SNAPSHOT = 'QUAKESOUNDS_SNAPSHOT'
+
+# Messages
+RELOAD = 'reload'
+RESULT = 'result'
+RECENT = 'recent'
+
+
+def write_snapshot(path, snapshot):
+    """Replaces the snapshot at path at once, so that workers never read half of it."""
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as snapshot_file:
+        pickle.dump(snapshot, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+
+
+def read_snapshot(path):
+    with open(path, 'rb') as snapshot_file:
+        return pickle.load(snapshot_file)
+
+
+class _Channel:
+    """JSON messages over a connected stream socket, one per line."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._reader = sock.makefile('rb')
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        data = json.dumps(message).encode() + b'\n'
+        with self._lock:
+            self.sock.sendall(data)
+
+    def __iter__(self):
+        for line in self._reader:
+            yield json.loads(line)
+
+    def close(self):
+        self._reader.close()
+        self.sock.close()
+
+
+class Supervisor:
+    """Starts processes workers of command serving host:port and restarts those that exit.
+
+    on_message(index, message) is called, from a thread per worker, with every message a worker
+    sends. Workers receive the messages given to broadcast().
+    """
+
+    def __init__(self, processes, host, port, on_message, command=None, check_interval=1.0):
+        global LOG
+        LOG = logger.get_logger('supervisor')
+        self.processes = processes
+        self.host = host
+        self.port = port
+        self.on_message = on_message
+        self.command = command or [sys.executable] + sys.argv
+        self.check_interval = check_interval
+        self.restarts = 0
+        # Workers unpickle the snapshot, so it lives in a directory only this user can write to,
+        # unlike the shared temporary directory where anyone could plant a file at a guessed path.
+        self.snapshot_dir = tempfile.mkdtemp(prefix='quakesounds-')
+        self.snapshot_path = os.path.join(self.snapshot_dir, 'catalogue.pickle')
+        self._workers = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._socket = None
+
+    def start(self, snapshot):
+        """Writes the first catalogue snapshot, binds the listening socket and starts every worker."""
+        write_snapshot(self.snapshot_path, snapshot)
+        # socket.create_server() only exists since Python 3.8.
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, int(self.port)))
+        self._socket.listen(1024)
+        self.port = self._socket.getsockname()[1]
+        for index in range(self.processes):
+            self._spawn(index)
+        LOG.info('Started %d workers on %s:%d.', self.processes, self.host, self.port)
+        return self
+
+    def _spawn(self, index):
+        channel_socket, worker_socket = socket.socketpair()
+        env = dict(os.environ)
+        env[_ENV_LISTEN_FD] = str(self._socket.fileno())
+        env[_ENV_CHANNEL_FD] = str(worker_socket.fileno())
+        env[_ENV_SNAPSHOT] = self.snapshot_path
+        process = subprocess.Popen(self.command, env=env,
+                                   pass_fds=(self._socket.fileno(), worker_socket.fileno()))
+        worker_socket.close()
+        channel = _Channel(channel_socket)
+        with self._lock:
+            self._workers[index] = (process, channel)
+        threading.Thread(target=self._receive, args=(index, channel), name='supervisor-%d' % index,
+                         daemon=True).start()
+        LOG.debug('Started worker %d, pid %d.', index, process.pid)
+
+    def _receive(self, index, channel):
+        try:
+            for message in channel:
+                try:
+                    self.on_message(index, message)
+                except Exception as e:
+                    LOG.error('Could not handle %s from worker %d: %s', message, index, e)
+        except (OSError, ValueError):
+            pass  # The worker exited, run() restarts it.
+
+    def broadcast(self, message, exclude=None):
+        """Sends message to every worker but exclude."""
+        with self._lock:
+            channels = [(index, channel) for index, (process, channel) in self._workers.items() if index != exclude]
+        for index, channel in channels:
+            try:
+                channel.send(message)
+            except OSError as e:
+                LOG.warning('Could not send %s to worker %d: %s', message['type'], index, e)
+
+    def publish(self, snapshot):
+        """Replaces the catalogue snapshot and tells workers to load it."""
+        write_snapshot(self.snapshot_path, snapshot)
+        self.broadcast({'type': RELOAD})
+
+    def alive(self):
+        with self._lock:
+            return sum(process.poll() is None for process, channel in self._workers.values())
+
+    def run(self):
+        """Restarts workers that exit until SIGTERM or SIGINT, then stops them all."""
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self._stopping.set())
+        while not self._stopping.wait(self.check_interval):
+            with self._lock:
+                exited = [(index, process.returncode) for index, (process, channel) in self._workers.items()
+                          if process.poll() is not None]
+            for index, returncode in exited:
+                LOG.error('Worker %d exited with %s, restarting it.', index, returncode)
+                self._workers[index][1].close()
+                self.restarts += 1
+                self._spawn(index)
+        self.stop()
+
+    def stop(self, timeout=10.0):
+        with self._lock:
+            workers = list(self._workers.values())
+            self._workers = {}
+        for process, channel in workers:
+            if process.poll() is None:
+                process.terminate()
+        for process, channel in workers:
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            channel.close()
+        if self._socket is not None:
+            self._socket.close()
+        shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+        LOG.info('Stopped %d workers.', len(workers))
+
+
+class Worker:
+    """Side of a process started by a Supervisor: its listening socket, snapshot and channel."""
+
+    def __init__(self, listen_fd, channel_fd, snapshot_path):
+        global LOG
+        LOG = logger.get_logger('supervisor')
+        # Python 3.6 does not detect the family and type of a socket given by its file descriptor.
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, fileno=listen_fd)
+        self.snapshot_path = snapshot_path
+        self._channel = _Channel(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, fileno=channel_fd))
+
+    @classmethod
+    def from_environment(cls):
+        """Worker of the process when it was started by a Supervisor, otherwise None."""
+        try:
+            return cls(int(os.environ[_ENV_LISTEN_FD]), int(os.environ[_ENV_CHANNEL_FD]), os.environ[_ENV_SNAPSHOT])
+        except KeyError:
+            return None
+
+    def snapshot(self):
+        return read_snapshot(self.snapshot_path)
+
+    def send(self, message):
+        self._channel.send(message)
+
+    def start(self, on_message):
+        """Calls on_message with every message of the supervisor from a background thread.
+
+        The process is terminated when the supervisor goes away.
+        """
+        def receive():
+            try:
+                for message in self._channel:
+                    try:
+                        on_message(message)
+                    except Exception as e:
+                        LOG.error('Could not handle %s from the supervisor: %s', message, e)
+            except (OSError, ValueError):
+                pass
+            LOG.error('Lost the supervisor, stopping.')
+            os.kill(os.getpid(), signal.SIGTERM)
+        threading.Thread(target=receive, name='supervisor', daemon=True).start()
+        return self
@@ -0,0 +1,44 @@
+import os
+import threading
+import logger
+
+
+class FileWatcher:
+    """Calls on_change from a background thread whenever the watched file is modified."""
+
+    def __init__(self, path, on_change, interval=5.0):
+        global LOG
+        LOG = logger.get_logger('watcher')
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._last_stat = self._stat()
+        self._thread = threading.Thread(target=self._run, name='file-watcher', daemon=True)
+
+    def start(self):
+        LOG.info('Watching %s for changes every %s seconds.', self.path, self.interval)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            current = self._stat()
+            if current is None or current == self._last_stat:
+                continue
+            self._last_stat = current
+            LOG.info('%s changed.', self.path)
+            try:
+                self.on_change()
+            except Exception as e:
+                LOG.error('Could not apply changes of %s: %s', self.path, e)
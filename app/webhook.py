@@ -1,40 +1,92 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import asyncio
 import logger
 from aiohttp import web
 import telebot
+import metrics
+import static
+from dispatcher import AsyncUpdateDispatcher, UpdateDispatcher
 
+# Updates accepted but not yet processed, per worker. Beyond that, requests wait before being acked.
+MAX_PENDING_PER_WORKER = 32
 
-def start_webhook(bot, webhook_host, webhook_port, listening_ip, listening_port):
-    global LOG
-    LOG = logger.get_logger('webhook')
-    LOG.info("Starting webhook on {}:{}".format(webhook_host, webhook_port))
+
+def set_webhook(bot, webhook_host, webhook_port):
+    """Points the webhook of bot to webhook_host:webhook_port."""
     webhook_url_base = "https://{}:{}".format(webhook_host, webhook_port)
     webhook_url_path = "/{}/".format(bot.token)
 
+    # Remove webhook, it fails sometimes the set if there is a previous webhook
+    bot.remove_webhook()
+
+    # Set webhook
+    bot.set_webhook(url=webhook_url_base+webhook_url_path)
+
+
+def start_webhook(bot, webhook_host, webhook_port, listening_ip, listening_port, workers=8, runtime=None,
+                  sound_files=None, sock=None):
+    """Serves the webhook of bot. Updates are handled by an UpdateDispatcher with workers threads, or
+    by runtime, an asyncbot.AsyncRuntime, on the event loop of the server. sound_files, a
+    static.SoundFiles, are also served when given.
+
+    sock is a listening socket shared with other processes, by supervisor.Supervisor. Updates are
+    then accepted from it, and setting the webhook is left to the process that created it."""
+    global LOG
+    LOG = logger.get_logger('webhook')
+    LOG.info("Starting webhook on %s:%s", webhook_host, webhook_port)
+
     app = web.Application()
+    dispatcher = UpdateDispatcher(bot, workers)
+    async_dispatcher = AsyncUpdateDispatcher(runtime.process) if runtime is not None else None
+    pending = {}
+    metrics.callback('quakesounds_dispatcher_in_flight', 'Updates accepted and not processed yet.',
+                     dispatcher.in_flight)
+
+    async def on_startup(app):
+        loop = asyncio.get_event_loop()
+        pending['slots'] = asyncio.Semaphore(workers * MAX_PENDING_PER_WORKER)
+        pending['release'] = lambda: loop.call_soon_threadsafe(pending['slots'].release)
+
+    async def on_shutdown(app):
+        dispatcher.shutdown()
+        if runtime is not None:
+            await runtime.close()
 
     # Process webhook calls
     async def handle(request):
         if request.match_info.get('token') == bot.token:
             request_body_dict = await request.json()
             update = telebot.types.Update.de_json(request_body_dict)
-            bot.process_new_updates([update])
+            await pending['slots'].acquire()
+            if runtime is None:
+                dispatcher.submit(update, on_done=pending['release'])
+            else:
+                async_dispatcher.submit(update, on_done=pending['slots'].release)
             return web.Response()
         else:
             return web.Response(status=403)
 
+    async def handle_metrics(request):
+        return web.Response(body=metrics.render().encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
     app.router.add_post('/{token}/', handle)
+    app.router.add_get('/metrics', handle_metrics)
+    if sound_files is not None:
+        static.add_routes(app, sound_files)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
 
-    # Remove webhook, it fails sometimes the set if there is a previous webhook
-    bot.remove_webhook()
+    if sock is not None:
+        LOG.debug("Starting aiohttp on a shared socket with %d workers", workers)
+        web.run_app(app, sock=sock)
+        return
 
-    # Set webhook
-    bot.set_webhook(url=webhook_url_base+webhook_url_path)
+    set_webhook(bot, webhook_host, webhook_port)
 
     # Start aiohttp server
-    LOG.debug("Starting aiohttp on interface {}:{}".format(listening_ip, listening_port))
+    LOG.debug("Starting aiohttp on interface %s:%s with %d workers", listening_ip, listening_port, workers)
     web.run_app(
         app,
         host=listening_ip,
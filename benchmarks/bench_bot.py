@@ -0,0 +1,218 @@
+"""Benchmark of the bot handlers on a synthetic catalogue and history.
+
+Generates a data JSON with --sounds sounds and a SQLite history of --queries queries and --results
+results from --users users, then imports the bot against them with a stubbed TeleBot that
+serializes answers instead of sending them. Every handler is timed separately and its latency
+percentiles, throughput and peak memory are printed and written as JSON to --output, so that runs
+can be compared. The same --seed always generates the same data. Run from the repository root:
+
+    python benchmarks/bench_bot.py --sounds 2000 --users 5000 --output bench.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import telebot
+from telebot import apihelper, types
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP_DIR)
+
+ADMIN = 'bench_admin'
+WORDS = ['headshot', 'humiliation', 'excellent', 'impressive', 'perfect', 'denied', 'fight', 'prepare', 'to',
+         'lead', 'taken', 'lost', 'the', 'you', 'have', 'red', 'blue', 'flag', 'return', 'capture', 'double',
+         'multi', 'mega', 'ultra', 'monster', 'ludicrous', 'holy', 'shit', 'kill', 'killing', 'spree',
+         'rampage', 'dominating', 'unstoppable', 'godlike', 'wicked', 'sick', 'first', 'blood', 'one', 'two',
+         'three', 'frags', 'left', 'sudden', 'death', 'railgun', 'rocket', 'launcher', 'quad', 'damage',
+         'accuracy', 'gauntlet', 'assist', 'defense', 'teleport', 'armor', 'mega', 'health', 'voice']
+LANGUAGES = ['en', 'es', 'de', 'fr', 'pt-br', None]
+
+
+class StubTeleBot(telebot.TeleBot):
+    """TeleBot that pays the cost of serializing what it would send, but never sends it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent_bytes = 0
+
+    def answer_inline_query(self, inline_query_id, results, cache_time=None, is_personal=None, next_offset=None,
+                            *args, **kwargs):
+        self.sent_bytes += len(apihelper._convert_list_json_serializable(results))
+        return True
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        self.sent_bytes += len(text.encode())
+
+
+def generate_sounds(rng, count):
+    sounds = []
+    for i in range(count):
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+        tags = ' '.join(rng.sample(WORDS, 2))
+        sounds.append({'filename': 'sound{:06d}.ogg'.format(i), 'text': text, 'tags': tags})
+    return sounds
+
+
+def generate_users(rng, count):
+    return [{'id': 100000 + i, 'is_bot': False, 'first_name': 'User {}'.format(i), 'last_name': None,
+             'username': 'user{}'.format(i), 'language_code': rng.choice(LANGUAGES)} for i in range(count)]
+
+
+def generate_history(rng, database, sounds, users, queries, results, days, batch_size=5000):
+    """Fills database with queries and results spread over the last days."""
+    now = datetime.datetime.now()
+    telegram_users = [types.User.de_json(user) for user in users]
+
+    def timestamp():
+        return now - datetime.timedelta(seconds=rng.uniform(0, days * 86400))
+
+    for start in range(0, queries, batch_size):
+        database.add_queries([(rng.choice(telegram_users), typed_query(rng, rng.choice(sounds).text), timestamp(),
+                               rng.randint(1, 8)) for _ in range(min(batch_size, queries - start))])
+    for start in range(0, results, batch_size):
+        database.add_results([(rng.choice(telegram_users), str(rng.choice(sounds).id), timestamp())
+                              for _ in range(min(batch_size, results - start))])
+
+
+def typed_query(rng, text):
+    """A prefix of text, as sent by Telegram while the user is typing it."""
+    return text[:rng.randint(1, len(text))]
+
+
+def inline_query(rng, users, text):
+    return types.InlineQuery.de_json({'id': str(rng.getrandbits(63)), 'from': rng.choice(users), 'query': text,
+                                      'offset': ''})
+
+
+def chosen_result(rng, users, sounds):
+    sound = rng.choice(sounds)
+    return types.ChosenInlineResult.de_json({'result_id': str(sound.id), 'from': rng.choice(users),
+                                             'query': sound.text})
+
+
+def admin_message(rng):
+    return types.Message.de_json({'message_id': rng.getrandbits(31), 'date': int(time.time()),
+                                  'chat': {'id': 1, 'type': 'private'},
+                                  'from': {'id': 1, 'is_bot': False, 'first_name': 'Admin', 'username': ADMIN},
+                                  'text': '/stats'})
+
+
+def measure(operation, iterations, memory_iterations):
+    """Times iterations calls of operation, then traces memory over memory_iterations more."""
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for _ in range(memory_iterations):
+        operation()
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    total = sum(latencies)
+    return {'iterations': iterations,
+            'p50_ms': percentile(latencies, 50) * 1e3,
+            'p99_ms': percentile(latencies, 99) * 1e3,
+            'mean_ms': total / iterations * 1e3,
+            'throughput_per_s': iterations / total if total else None,
+            'peak_memory_kib': peak / 1024}
+
+
+def percentile(sorted_values, percent):
+    return sorted_values[min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sounds', type=int, default=1000, help='Sounds in the catalogue. Default is 1000')
+    parser.add_argument('--users', type=int, default=2000, help='Distinct users. Default is 2000')
+    parser.add_argument('--queries', type=int, default=50000, help='Queries in the history. Default is 50000')
+    parser.add_argument('--results', type=int, default=20000, help='Results in the history. Default is 20000')
+    parser.add_argument('--history-days', type=int, default=30, help='Days the history spans. Default is 30')
+    parser.add_argument('--iterations', type=int, default=2000, help='Calls of every handler. Default is 2000')
+    parser.add_argument('--slow-iterations', type=int, default=20,
+                        help='Calls of synchronize_sounds and send_stats. Default is 20')
+    parser.add_argument('--search', type=str, default='prefix', help='Search mode of the bot. Default is prefix')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generated data. Default is 0')
+    parser.add_argument('--output', type=str, help='File where results are written as JSON')
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = os.path.join(tmp_dir, 'data.json')
+        with open(data_path, 'w') as data_file:
+            json.dump({'sounds': generate_sounds(rng, args.sounds)}, data_file)
+
+        for variable in ('TELEGRAM_BOT_TOKEN', 'TELEGRAM_USER_ALIAS', 'DATA_JSON', 'SQLITE_FILE', 'MYSQL_HOST',
+                         'WEBHOOK_HOST', 'LOGFILE'):
+            os.environ.pop(variable, None)
+        sys.argv = ['bot.py', '--token', '0:bench', '--admin', ADMIN, '--data', data_path,
+                    '--sqlite', os.path.join(tmp_dir, 'bench.sqlite'), '--search', args.search,
+                    '--data-watch-interval', '0', '--verbosity', 'ERROR']
+        telebot.TeleBot = StubTeleBot
+        setup_start = time.perf_counter()
+        import bot
+        setup_seconds = time.perf_counter() - setup_start
+
+        sounds = bot.catalogue.sounds
+        users = generate_users(rng, args.users)
+        history_start = time.perf_counter()
+        generate_history(rng, bot.database, sounds, users, args.queries, args.results, args.history_days)
+        history_seconds = time.perf_counter() - history_start
+
+        memory_iterations = max(1, args.iterations // 10)
+        slow_memory_iterations = max(1, args.slow_iterations // 10)
+        benchmarks = {
+            'query_text': lambda: bot.query_text(inline_query(rng, users, typed_query(rng, rng.choice(sounds).text))),
+            'query_empty': lambda: bot.query_empty(inline_query(rng, users, '')),
+            'add_query': lambda: bot.database.add_query(
+                inline_query(rng, users, typed_query(rng, rng.choice(sounds).text))),
+            'add_result': lambda: bot.database.add_result(chosen_result(rng, users, sounds)),
+        }
+        slow_benchmarks = {
+            'synchronize_sounds': bot.synchronize_sounds,
+            'send_stats': lambda: bot.send_stats(admin_message(rng)),
+        }
+        report = {}
+        for name, operation in benchmarks.items():
+            report[name] = measure(operation, args.iterations, memory_iterations)
+        for name, operation in slow_benchmarks.items():
+            report[name] = measure(operation, args.slow_iterations, slow_memory_iterations)
+
+        # Let the history written by the handlers reach the database before it is removed.
+        if bot.queries:
+            bot.queries.stop()
+        bot.history.stop()
+
+    output = {'config': vars(args),
+              'python': platform.python_version(),
+              'setup_s': setup_seconds,
+              'history_generation_s': history_seconds,
+              'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              'answered_bytes': bot.bot.sent_bytes,
+              'benchmarks': report}
+    print('{:<20} {:>10} {:>10} {:>10} {:>12} {:>12}'.format('handler', 'p50 ms', 'p99 ms', 'mean ms', 'ops/s',
+                                                            'peak KiB'))
+    for name, result in report.items():
+        print('{:<20} {p50_ms:>10.3f} {p99_ms:>10.3f} {mean_ms:>10.3f} {throughput_per_s:>12.0f} '
+              '{peak_memory_kib:>12.1f}'.format(name, **result))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2, sort_keys=True)
+        print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""Microbenchmark of query normalization.
+
+Compares the normalizer against the former unidecode based pipeline, for ASCII and non ASCII
+queries, with a cold and a warm memo. Run from the repository root:
+
+    python benchmarks/bench_normalizer.py
+"""
+import os
+import string
+import sys
+import timeit
+
+import unidecode
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import normalizer  # noqa: E402
+
+REMOVE_CHARS = string.punctuation + string.whitespace
+QUERIES = {
+    'ascii': ['h', 'he', 'hea', 'head', 'headsh', 'headshot', 'double kill', 'Multi-Kill!', 'LUDICROUS kill'],
+    'unicode': ['cañón', 'Ünstoppable', 'ludicrous kíll', 'héadshot', '¡perfect!', 'godlike 🔥'],
+}
+NUMBER = 20000
+
+
+def legacy(text):
+    return unidecode.unidecode(text.translate(REMOVE_CHARS).lower())
+
+
+def run(name, function, queries):
+    seconds = timeit.timeit(lambda: [function(query) for query in queries], number=NUMBER)
+    per_call = seconds / (NUMBER * len(queries)) * 1e9
+    print('{:<28} {:>10.0f} ns/query'.format(name, per_call))
+
+
+def main():
+    for kind, queries in QUERIES.items():
+        print('{} queries'.format(kind))
+        run('  legacy unidecode', legacy, queries)
+        run('  normalizer (no memo)', normalizer._normalize, queries)
+        normalizer.normalize.cache_clear()
+        run('  normalizer (memoized)', normalizer.normalize, queries)
+    print(normalizer.normalize.cache_info())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,54 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib.request
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import telebot
 from persistence import *
+from persistence import writebehind
+from persistence.cache import RecentSoundsCache, UserCache
+from persistence.stats import Stats
+from persistence.retention import Retention
+from persistence.debounce import QueryCoalescer
 import logger
+import metrics
+import normalizer
+import paging
+import ranking
+import search
+from results import ResultCatalog
+import media
+import static
+import supervisor
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from dispatcher import AsyncUpdateDispatcher, UpdateDispatcher
+from watcher import FileWatcher
+from handlers import Handlers, reply
+
+FakeSound = namedtuple('FakeSound', 'id filename text tags')
+FakeUser = namedtuple('FakeUser', 'id is_bot first_name last_name username language_code')
+FakeQuery = namedtuple('FakeQuery', 'from_user query')
+FakeResult = namedtuple('FakeResult', 'from_user result_id')
+FakeUpdate = namedtuple('FakeUpdate', 'update_id inline_query')
+
+LOG_NAME = 'QuakeSounds_Bot.test'
+logger.set_logger(LOG_NAME)
 
 class PersistenceTest(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        LOG_NAME = 'QuakeSounds_Bot.test'
-        logger.set_logger(LOG_NAME)
         cls.db = Database(provider='sqlite')
 
     def test_populate_sounds(self):
@@ -72,5 +113,902 @@ class PersistenceTest(unittest.TestCase):
         self.assertEqual(db_updated_user, input_a)
 
 
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        # The history writer runs on its own thread, so it needs a database shared between connections.
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = Database(provider='sqlite', filename=os.path.join(self.tmp_dir.name, 'db.sqlite'))
+        self.db.add_sound(1, 'filenameA', 'text A', 'tags A')
+        self.user = FakeUser(10, False, 'first name', None, 'username', 'en')
+
+    def tearDown(self):
+        self.db.db.disconnect()
+        self.tmp_dir.cleanup()
+
+    def test_sqlite_tuning(self):
+        self.assertTrue(self.db.ping())
+        with db_session:
+            self.assertEqual(self.db.db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(self.db.db.execute('PRAGMA synchronous').fetchone()[0], 1)
+
+    def test_add_queries(self):
+        now = datetime.datetime.now()
+        self.db.add_queries([(self.user, 'a', now, 1), (self.user, 'ab', now, 2)])
+        self.assertEqual(len(self.db.get_queries()), 2)
+        self.assertEqual(self.db.get_user(id=10)['username'], 'username')
+
+    def test_user_cache(self):
+        now = datetime.datetime.now()
+        self.db.add_queries([(self.user, 'a', now, 1)])
+        self.db.add_queries([(self.user, 'ab', now, 1)])
+        self.assertEqual(self.db.user_cache.hits, 1)
+        self.assertIsNone(self.db.add_or_update_user(self.user))
+        renamed = self.user._replace(username='renamed')
+        self.db.add_results([(renamed, '1', now)])
+        self.assertEqual(self.db.get_user(id=10)['username'], 'renamed')
+        self.assertIsNone(self.db.add_or_update_user(renamed))
+
+        cache = UserCache(capacity=1, ttl=0)
+        cache.store([user_to_dict(self.user)])
+        self.assertFalse(cache.is_current(user_to_dict(self.user)))
+        cache = UserCache(capacity=1)
+        cache.store([user_to_dict(self.user), user_to_dict(renamed._replace(id=11))])
+        self.assertFalse(cache.is_current(user_to_dict(self.user)))
+        self.assertTrue(cache.is_current(user_to_dict(renamed._replace(id=11))))
+
+    def test_add_results(self):
+        now = datetime.datetime.now()
+        self.db.add_results([(self.user, '1', now), (self.user, '2', now)])
+        self.assertEqual(len(self.db.get_results()), 1)
+
+    def test_write_behind_drains_on_stop(self):
+        history = writebehind.WriteBehindQueue(self.db, batch_size=3, flush_interval=0.05).start()
+        for text in ('h', 'he', 'hea', 'head'):
+            history.add_query(FakeQuery(self.user, text))
+        history.add_result(FakeResult(self.user, '1'))
+        history.stop()
+        self.assertEqual(len(self.db.get_queries()), 4)
+        self.assertEqual(len(self.db.get_results()), 1)
+        self.assertEqual(history.written, 5)
+
+    def test_write_behind_drop_policy(self):
+        history = writebehind.WriteBehindQueue(self.db, max_size=2, drop_policy=writebehind.DROP_NEWEST,
+                                               block_timeout=0)
+        self.assertTrue(history.add_query(FakeQuery(self.user, 'a')))
+        self.assertTrue(history.add_query(FakeQuery(self.user, 'b')))
+        self.assertFalse(history.add_query(FakeQuery(self.user, 'c')))
+        self.assertEqual(history.dropped, 1)
+        history = writebehind.WriteBehindQueue(self.db, max_size=2, block_timeout=0)
+        for text in ('a', 'b', 'c'):
+            self.assertTrue(history.add_query(FakeQuery(self.user, text)))
+        self.assertEqual([event[2] for event in history.queue.queue], [('b', 1), ('c', 1)])
+
+    def test_write_behind_retries(self):
+        class FlakyDatabase:
+            failures = 2
+            pings = 0
+            batches = []
+
+            def ping(self):
+                self.pings += 1
+                return True
+
+            def add_history(self, queries, results):
+                if self.failures:
+                    self.failures -= 1
+                    raise OSError('connection lost')
+                self.batches.append((queries, results))
+        database = FlakyDatabase()
+        history = writebehind.WriteBehindQueue(database, flush_interval=0.05, retry_backoff=0.01).start()
+        history.add_query(FakeQuery(self.user, 'a'))
+        history.add_result(FakeResult(self.user, '1'))
+        history.stop()
+        self.assertEqual((history.written, history.dropped), (2, 0))
+        self.assertEqual([(len(queries), len(results)) for queries, results in database.batches], [(1, 1)])
+        self.assertEqual(database.pings, 2)
+        database.failures = 10
+        history = writebehind.WriteBehindQueue(database, flush_interval=0.05, max_retries=1,
+                                               retry_backoff=0.01).start()
+        history.add_query(FakeQuery(self.user, 'b'))
+        history.stop()
+        self.assertEqual((history.written, history.dropped), (0, 1))
+
+    def test_latest_used_sounds(self):
+        now = datetime.datetime.now()
+        self.db.add_sound(2, 'filenameB', 'text B', 'tags B')
+        self.db.add_sound(3, 'filenameC', 'text C', 'tags C')
+        self.db.add_results([(self.user, '1', now - datetime.timedelta(seconds=3)),
+                             (self.user, '2', now - datetime.timedelta(seconds=2)),
+                             (self.user, '3', now - datetime.timedelta(seconds=1)),
+                             (self.user, '1', now)])
+        sounds = self.db.get_latest_used_sounds_from_user(self.user.id)
+        self.assertEqual([sound.id for sound in sounds], [1, 3, 2])
+        self.assertEqual([sound.id for sound in self.db.get_latest_used_sounds_from_user(self.user.id, limit=1)], [1])
+        self.assertEqual(self.db.get_latest_used_sounds_from_user(99), [])
+
+    def test_coalesced_queries(self):
+        history = writebehind.WriteBehindQueue(self.db, flush_interval=0.05).start()
+        coalescer = QueryCoalescer(history, idle_window=60).start()
+        other_user = FakeUser(11, False, 'other', None, None, None)
+        for text in ('h', 'he', 'hea', 'head'):
+            coalescer.add_query(FakeQuery(self.user, text))
+        coalescer.add_query(FakeQuery(other_user, 'k'))
+        self.assertEqual(coalescer.pending(), 2)
+        coalescer.flush(self.user.id)
+        coalescer.add_query(FakeQuery(self.user, 'g'))
+        coalescer.stop()
+        history.stop()
+        with db_session:
+            queries = select((q.user.id, q.text, q.collapsed) for q in self.db.db.QueryHistory).order_by(1, 3)[:]
+        self.assertEqual(queries, [(10, 'g', 1), (10, 'head', 4), (11, 'k', 1)])
+        self.assertEqual(coalescer.collapsed, 3)
+        self.assertEqual(Stats(self.db).totals()['keystrokes'], 6)
+
+    def test_schema_upgrade_adds_columns(self):
+        self.db.add_queries([(self.user, 'he', datetime.datetime.now(), 2)])
+        with db_session:
+            # SQLite can't drop columns before 3.35, so the table is rebuilt without the column.
+            self.db.db.execute('CREATE TABLE old_queries AS SELECT id, user, text, timestamp FROM QueryHistory')
+            self.db.db.execute('DROP TABLE QueryHistory')
+            self.db.db.execute('ALTER TABLE old_queries RENAME TO QueryHistory')
+        self.db.db.disconnect()
+        upgraded = Database(provider='sqlite', filename=os.path.join(self.tmp_dir.name, 'db.sqlite'))
+        with db_session:
+            self.assertEqual(select(q.collapsed for q in upgraded.db.QueryHistory)[:], [1])
+
+    def test_schema_upgrade(self):
+        now = datetime.datetime.now()
+        self.db.add_results([(self.user, '1', now)])
+        with db_session:
+            delete(r for r in self.db.db.UserRecentSound)
+            self.db.db.execute('DROP INDEX idx_resulthistory_user_sound_id')
+        self.db.db.disconnect()
+        upgraded = Database(provider='sqlite', filename=os.path.join(self.tmp_dir.name, 'db.sqlite'))
+        self.assertEqual([sound.id for sound in upgraded.get_latest_used_sounds_from_user(self.user.id)], [1])
+        with db_session:
+            self.assertTrue(upgraded.db.select("SELECT name FROM sqlite_master "
+                                               "WHERE name = 'idx_resulthistory_user_sound_id'"))
+
+    def test_sync_sounds(self):
+        json_sounds = [{'filename': 'filenameB', 'text': 'text B', 'tags': 'tags B'},
+                       {'filename': 'filenameA', 'text': 'new text A', 'tags': 'tags A'}]
+        sounds, report = self.db.sync_sounds(json_sounds)
+        self.assertEqual([sound.filename for sound in sounds], ['filenameB', 'filenameA'])
+        self.assertEqual(report, SyncReport(['filenameB'], ['filenameA'], []))
+        self.assertEqual(self.db.get_sound(id=1).text, 'new text A')
+
+        sounds, report = self.db.sync_sounds(json_sounds[:1])
+        self.assertEqual([sound.filename for sound in sounds], ['filenameB'])
+        self.assertEqual(report, SyncReport([], [], ['filenameA']))
+        self.assertTrue(self.db.get_sound(id=1).disabled)
+
+        sounds, report = self.db.sync_sounds(json_sounds)
+        self.assertEqual(report, SyncReport([], ['filenameA'], []))
+        self.assertEqual(len(self.db.get_sounds(include_disabled=False)), 2)
+        self.db.set_sound_media(1, 'hash', 'file-1')
+        sounds, report = self.db.sync_sounds(json_sounds)
+        self.assertEqual(report, SyncReport([], [], []))
+        self.assertEqual([(sound.file_id, sound.content_hash) for sound in sounds], [(None, None), ('file-1', 'hash')])
+
+    def test_migration_resumes_from_checkpoint(self):
+        now = datetime.datetime.now()
+        self.db.add_queries([(self.user, 'query %d' % i, now, 1) for i in range(5)])
+        self.db.add_results([(self.user, '1', now)])
+        to_db = Database(provider='sqlite', filename=os.path.join(self.tmp_dir.name, 'to.sqlite'))
+        checkpoint = os.path.join(self.tmp_dir.name, 'migration.json')
+        migrate(self.db, to_db, chunk_size=2, checkpoint_path=checkpoint)
+        self.assertEqual(len(to_db.get_queries()), 5)
+        self.assertEqual(len(to_db.get_results()), 1)
+        self.assertEqual(to_db.get_user(id=10), self.db.get_user(id=10))
+        with open(checkpoint) as checkpoint_file:
+            self.assertEqual(json.load(checkpoint_file)['QueryHistory'], 5)
+
+        self.db.add_queries([(self.user, 'query 5', now, 1)])
+        Migrator(self.db, to_db, chunk_size=2, checkpoint_path=checkpoint).run()
+        self.assertEqual(len(to_db.get_queries()), 6)
+        self.assertEqual(len(to_db.get_sounds()), 1)
+
+    def test_migration_keeps_rollups(self):
+        now = datetime.datetime.now()
+        old = now - datetime.timedelta(days=40)
+        other_user = FakeUser(11, False, 'other', None, None, None)
+        self.db.add_sound(2, 'filenameB', 'Text B', 'b')
+        self.db.add_queries([(self.user, 'he', old, 2), (other_user, 'ki', old - datetime.timedelta(days=1), 1),
+                             (self.user, 'he', now, 1)])
+        self.db.add_results([(self.user, '1', old), (other_user, '2', old), (other_user, '1', old),
+                             (self.user, '2', now)])
+        Retention(self.db, keep_days=30).run()
+        self.db.save_popularity([(1, '*', 2.0), (2, '*', 1.0), (1, 'en', 1.0)], now)
+        stats = Stats(self.db)
+        to_db = Database(provider='sqlite', filename=os.path.join(self.tmp_dir.name, 'to.sqlite'))
+        checkpoint = os.path.join(self.tmp_dir.name, 'migration.json')
+        migrate(self.db, to_db, chunk_size=2, checkpoint_path=checkpoint)
+        # Resuming reads the composite keys, dates included, back from the checkpoint.
+        Migrator(self.db, to_db, chunk_size=2, checkpoint_path=checkpoint).run()
+        to_stats = Stats(to_db)
+        self.assertEqual((to_stats.totals(), to_stats.sound_uses(), to_stats.top_queries(days=60)),
+                         (stats.totals(), stats.sound_uses(), stats.top_queries(days=60)))
+        self.assertEqual(to_stats.daily_active_users(days=60), stats.daily_active_users(days=60))
+        self.assertEqual(sorted(to_db.get_popularity()), sorted(self.db.get_popularity()))
+        for user_id in (10, 11):
+            self.assertEqual(to_db.get_latest_used_sounds_from_user(user_id),
+                             self.db.get_latest_used_sounds_from_user(user_id))
+        self.assertEqual(Retention(to_db, keep_days=30).run(), (0, 0))
+
+    def test_retention_keeps_stats(self):
+        now = datetime.datetime.now()
+        old = now - datetime.timedelta(days=40)
+        other_user = FakeUser(11, False, 'other', None, None, None)
+        self.db.add_queries([(self.user, 'he', old, 2), (self.user, 'he', old, 1), (other_user, 'ki', old, 2),
+                             (self.user, 'he', now, 1)])
+        self.db.add_results([(self.user, '1', old), (other_user, '1', old), (self.user, '1', now)])
+        stats = Stats(self.db)
+        before = (stats.totals(), stats.sound_uses(), stats.top_queries(days=60))
+
+        archive_dir = os.path.join(self.tmp_dir.name, 'archive')
+        rolled_up, purged = Retention(self.db, keep_days=30, batch_size=2, archive_dir=archive_dir).run()
+        self.assertEqual((rolled_up, purged), (10, 5))
+        self.assertEqual(len(self.db.get_queries()), 1)
+        self.assertEqual(len(os.listdir(archive_dir)), 2)
+        self.assertEqual((stats.totals(), stats.sound_uses(), stats.top_queries(days=60)), before)
+        self.assertEqual(stats.active_users(old - datetime.timedelta(days=1)), 2)
+        self.assertEqual([users for day, users in stats.daily_active_users(days=60)], [2, 1])
+        self.assertEqual([sound.id for sound in self.db.get_latest_used_sounds_from_user(self.user.id)], [1])
+        self.assertEqual(Retention(self.db, keep_days=30).run(), (0, 0))
+
+    def test_stats(self):
+        now = datetime.datetime.now()
+        other_user = FakeUser(11, False, 'other', None, None, None)
+        self.db.add_sound(2, 'filenameB', 'text B', 'tags B')
+        self.db.add_queries([(self.user, 'he', now, 2), (self.user, 'he', now, 1), (other_user, 'ki', now, 1)])
+        self.db.add_results([(self.user, '1', now), (other_user, '1', now), (other_user, '2', now)])
+        stats = Stats(self.db)
+        self.assertEqual(stats.totals(), {'users': 2, 'queries': 3, 'keystrokes': 4, 'results': 3})
+        self.assertEqual(stats.sound_uses(), [(1, 'text A', 2), (2, 'text B', 1)])
+        self.assertEqual(stats.sound_uses(since=now + datetime.timedelta(seconds=1)), [])
+        self.assertEqual(stats.active_users(now - datetime.timedelta(days=1)), 2)
+        self.assertEqual(stats.daily_active_users(), [(str(now.date()), 2)])
+        self.assertEqual(stats.top_queries(), [('he', 2), ('ki', 1)])
+
+
+class RankingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database(provider='sqlite')
+        for sound_id in (1, 2, 3):
+            self.db.add_sound(sound_id, 'sound{}.ogg'.format(sound_id), 'text', 'tags')
+        self.sounds = self.db.get_sounds()
+        self.now = time.time()
+        self.ranking = ranking.Ranking(self.db, Stats(self.db), half_life_days=1, clock=lambda: self.now)
+
+    def test_seed_from_history(self):
+        english = FakeUser(10, False, 'first name', None, None, 'en-US')
+        spanish = FakeUser(11, False, 'first name', None, None, 'es')
+        now = datetime.datetime.fromtimestamp(self.now)
+        self.db.add_results([(english, '2', now), (spanish, '3', now), (spanish, '3', now)])
+        with db_session:
+            self.db.db.DailySoundUse(day=now.date() - datetime.timedelta(days=30), sound=1, uses=100)
+        orders = self.ranking.load().orders(self.sounds)
+        self.assertEqual([sound.id for sound in orders[ranking.GLOBAL]], [3, 2, 1])
+        self.assertEqual([sound.id for sound in orders['en']], [2, 3, 1])
+        self.assertEqual(set(orders), {ranking.GLOBAL, 'en', 'es'})
+
+    def test_decay(self):
+        self.ranking.record(1, 'en', timestamp=self.now - 86400)
+        self.ranking.record(2, 'en', timestamp=self.now)
+        scores = self.ranking.scores()
+        self.assertAlmostEqual(scores[1], 0.5)
+        self.assertAlmostEqual(scores[2], 1)
+        self.ranking.record(1, None, timestamp=self.now + 86400 * 60)
+        self.now += 86400 * 60
+        self.assertAlmostEqual(self.ranking.scores()[1], 1)
+
+    def test_snapshot(self):
+        self.ranking.record(1, 'en')
+        self.ranking.record(2, 'es')
+        self.ranking.snapshot()
+        self.now += 86400
+        loaded = ranking.Ranking(self.db, Stats(self.db), half_life_days=1, clock=lambda: self.now).load()
+        self.assertAlmostEqual(loaded.scores('es')[2], 0.5)
+        self.assertEqual(loaded.scores('en'), {1: loaded.scores()[1]})
+
+
+class RecentSoundsCacheTest(unittest.TestCase):
+
+    class FakeDatabase:
+        def __init__(self):
+            self.calls = 0
+
+        def get_latest_used_sounds_from_user(self, user_id, limit=3):
+            self.calls += 1
+            return ['sound %d' % i for i in range(limit)]
+
+    def test_hits_and_misses(self):
+        db = self.FakeDatabase()
+        cache = RecentSoundsCache(db, capacity=2, limit=2)
+        self.assertEqual(cache.get(1), ['sound 0', 'sound 1'])
+        self.assertEqual(cache.get(1), ['sound 0', 'sound 1'])
+        self.assertEqual((db.calls, cache.hits, cache.misses), (1, 1, 1))
+
+    def test_record_updates_cached_users(self):
+        cache = RecentSoundsCache(self.FakeDatabase(), limit=2)
+        cache.get(1)
+        cache.record(1, 'sound 1')
+        self.assertEqual(cache.get(1), ['sound 1', 'sound 0'])
+        cache.record(1, 'new')
+        self.assertEqual(cache.get(1), ['new', 'sound 1'])
+
+    def test_record_merges_uncached_users(self):
+        db = self.FakeDatabase()
+        cache = RecentSoundsCache(db, limit=3)
+        cache.record(1, 'sound 1')
+        cache.record(1, 'new')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get(1), ['new', 'sound 1', 'sound 0'])
+        self.assertEqual(cache.get(1), ['new', 'sound 1', 'sound 0'])
+        self.assertEqual(db.calls, 1)
+
+    def test_lru_eviction(self):
+        db = self.FakeDatabase()
+        cache = RecentSoundsCache(db, capacity=2)
+        cache.get(1)
+        cache.get(2)
+        cache.get(1)
+        cache.get(3)
+        self.assertEqual(list(cache._entries), [1, 3])
+        cache.get(2)
+        self.assertEqual(db.calls, 4)
+
+
+class UpdateDispatcherTest(unittest.TestCase):
+
+    class FakeBot:
+        def __init__(self):
+            self.processed = []
+            self.lock = threading.Lock()
+
+        def process_new_updates(self, updates):
+            time.sleep(0.01)
+            with self.lock:
+                self.processed.extend(update.update_id for update in updates)
+
+    def test_per_user_order(self):
+        bot = self.FakeBot()
+        dispatcher = UpdateDispatcher(bot, workers=4)
+        done = threading.Semaphore(0)
+        for update_id in range(20):
+            query = FakeQuery(FakeUser(update_id % 3, False, 'name', None, None, None), 'query')
+            dispatcher.submit(FakeUpdate(update_id, query), on_done=done.release)
+        for _ in range(20):
+            self.assertTrue(done.acquire(timeout=5))
+        dispatcher.shutdown()
+        self.assertEqual(sorted(bot.processed), list(range(20)))
+        for user_id in range(3):
+            user_updates = [update_id for update_id in bot.processed if update_id % 3 == user_id]
+            self.assertEqual(user_updates, sorted(user_updates))
+        self.assertEqual(dispatcher.in_flight(), 0)
+
+    def test_async_per_user_order(self):
+        processed = []
+
+        async def process(update):
+            await asyncio.sleep(0.01 if update.update_id < 3 else 0)
+            processed.append(update.update_id)
+        dispatcher = AsyncUpdateDispatcher(process)
+        done = []
+
+        async def submit():
+            tasks = [dispatcher.submit(FakeUpdate(update_id, FakeQuery(FakeUser(update_id % 3, False, 'name', None,
+                                                                                    None, None), 'query')),
+                                       on_done=lambda: done.append(1))
+                     for update_id in range(9)]
+            await asyncio.wait(tasks)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(submit())
+        loop.close()
+        self.assertEqual(sorted(processed), list(range(9)))
+        for user_id in range(3):
+            self.assertEqual([update_id for update_id in processed if update_id % 3 == user_id],
+                             [user_id, user_id + 3, user_id + 6])
+        self.assertEqual((len(done), dispatcher.in_flight()), (9, 0))
+
+
+class ResultCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sounds = [FakeSound(1, 'a.ogg', 'Text A', 'a'), FakeSound(2, 'b.ogg', 'Text B', 'b')]
+        self.catalog = ResultCatalog(self.sounds, 'https://bucket/')
+
+    def test_answer_serialization(self):
+        answer = self.catalog.answer(self.sounds[1:], recent_sounds=self.sounds[:1])
+        results = json.loads('[' + answer.to_json() + ']')
+        self.assertEqual(len(answer), 2)
+        self.assertEqual([r['voice_url'] for r in results], ['https://bucket/a.ogg', 'https://bucket/b.ogg'])
+        self.assertEqual([r['title'] for r in results], ['🕚 Text A', 'Text B'])
+        self.assertEqual(self.catalog.answer([]).to_json(), '')
+
+    def test_cached_answer(self):
+        calls = []
+
+        def build():
+            calls.append(1)
+            return self.catalog.answer(self.sounds)
+        first = self.catalog.cached_answer('text', build)
+        self.assertIs(self.catalog.cached_answer('text', build), first)
+        self.assertEqual(len(calls), 1)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer only exists since Python 3.7.
+    daemon_threads = True
+
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    """Bot API answering sendVoice with a new file_id for every upload."""
+
+    uploads = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        method = self.path.split('?', 1)[0].rsplit('/', 1)[-1]
+        self.uploads.append(method)
+        file_id = 'file-{}'.format(len(self.uploads))
+        body = json.dumps({'ok': True, 'result': {
+            'message_id': len(self.uploads), 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+            'voice': {'file_id': file_id, 'file_unique_id': file_id, 'duration': 1}}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MediaCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = Database(provider='sqlite', filename=os.path.join(self.tmp_dir.name, 'db.sqlite'))
+        self.db.add_sound(1, 'a.ogg', 'Text A', 'a')
+        self.write('a.ogg', b'first')
+        FakeBotApi.uploads = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotApi)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.api_url = telebot.apihelper.API_URL
+        telebot.apihelper.API_URL = 'http://127.0.0.1:{}/bot{{0}}/{{1}}'.format(self.server.server_port)
+        self.uploaded = threading.Event()
+        self.cache = media.MediaCache(telebot.TeleBot('1:token'), self.db, self.tmp_dir.name, 1,
+                                      upload_interval=0, on_uploaded=self.uploaded.set).start()
+
+    def tearDown(self):
+        self.cache.stop()
+        telebot.apihelper.API_URL = self.api_url
+        self.server.shutdown()
+        self.server.server_close()
+        self.db.db.disconnect()
+        self.tmp_dir.cleanup()
+
+    def write(self, filename, content):
+        with open(os.path.join(self.tmp_dir.name, filename), 'wb') as sound_file:
+            sound_file.write(content)
+
+    def file_ids(self):
+        self.uploaded.clear()
+        file_ids = self.cache.file_ids(self.db.get_sounds())
+        if self.cache.pending():
+            self.assertTrue(self.uploaded.wait(5))
+        return file_ids
+
+    def test_upload_once(self):
+        self.assertEqual(self.file_ids(), {})
+        self.assertEqual(FakeBotApi.uploads, ['sendVoice'])
+        sound = self.db.get_sound(id=1)
+        self.assertEqual((sound.file_id, sound.content_hash),
+                         ('file-1', media.content_hash(os.path.join(self.tmp_dir.name, 'a.ogg'))))
+        self.assertEqual(self.file_ids(), {1: 'file-1'})
+        self.assertEqual(FakeBotApi.uploads, ['sendVoice'])
+
+    def test_upload_again_when_content_changes(self):
+        self.file_ids()
+        self.write('a.ogg', b'second')
+        self.assertEqual(self.file_ids(), {})
+        self.assertEqual(self.file_ids(), {1: 'file-2'})
+        self.assertEqual(len(FakeBotApi.uploads), 2)
+
+    def test_lazy_upload(self):
+        self.cache.mode = media.UPLOAD_LAZY
+        self.assertEqual(self.file_ids(), {})
+        self.assertEqual(FakeBotApi.uploads, [])
+        self.uploaded.clear()
+        self.cache.request(self.db.get_sound(id=1))
+        self.assertTrue(self.uploaded.wait(5))
+        self.assertEqual(self.file_ids(), {1: 'file-1'})
+
+    def test_cached_results(self):
+        sounds = [FakeSound(1, 'a.ogg', 'Text A', 'a'), FakeSound(2, 'b.ogg', 'Text B', 'b')]
+        catalog = ResultCatalog(sounds, 'https://bucket/', file_ids={1: 'file-1'})
+        results = json.loads('[' + catalog.answer(sounds).to_json() + ']')
+        self.assertEqual([r['type'] for r in results], ['voice', 'voice'])
+        self.assertEqual(results[0]['voice_file_id'], 'file-1')
+        self.assertEqual(results[1]['voice_url'], 'https://bucket/b.ogg')
+
+
+class StaticTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tmp_dir.name, 'a.ogg'), 'wb') as sound_file:
+            sound_file.write(b'0123456789')
+        self.files = static.SoundFiles(self.tmp_dir.name)
+        self.hash = media.content_hash(os.path.join(self.tmp_dir.name, 'a.ogg'))
+        self.url = '{}{}/a.ogg'.format(static.SOUNDS_PATH, self.hash)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def get(self, path, **headers):
+        app = web.Application()
+        static.add_routes(app, self.files)
+
+        async def request():
+            async with TestClient(TestServer(app)) as client:
+                response = await client.get(path, headers=headers, allow_redirects=False)
+                return response.status, response.headers, await response.read()
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(request())
+        finally:
+            loop.close()
+
+    def test_paths(self):
+        self.assertEqual(self.files.paths(), {'a.ogg': '{}/a.ogg'.format(self.hash)})
+        sounds = [FakeSound(1, 'a.ogg', 'Text A', 'a')]
+        catalog = ResultCatalog(sounds, 'https://host/sounds/', paths=self.files.paths())
+        self.assertEqual(json.loads(catalog.answer(sounds).to_json())['voice_url'], 'https://host' + self.url)
+
+    def test_caching_headers(self):
+        status, headers, body = self.get(self.url)
+        self.assertEqual((status, body), (200, b'0123456789'))
+        self.assertEqual(headers['ETag'], '"{}"'.format(self.hash))
+        self.assertEqual(headers['Cache-Control'], static.CACHE_CONTROL)
+        status, headers, body = self.get(self.url, **{'If-None-Match': headers['ETag']})
+        self.assertEqual((status, body), (304, b''))
+
+    def test_if_match(self):
+        etag = '"{}"'.format(self.hash)
+        status, headers, body = self.get(self.url, **{'If-Match': etag, 'Range': 'bytes=2-5'})
+        self.assertEqual((status, body, headers['ETag']), (206, b'2345', etag))
+        self.assertEqual(self.get(self.url, **{'If-Match': '"other"'})[0], 412)
+
+    def test_range(self):
+        status, headers, body = self.get(self.url, Range='bytes=2-5')
+        self.assertEqual((status, body), (206, b'2345'))
+        self.assertEqual(headers['Content-Range'], 'bytes 2-5/10')
+
+    def test_stale_and_unknown_files(self):
+        status, headers, body = self.get(static.SOUNDS_PATH + '0' * 64 + '/a.ogg')
+        self.assertEqual((status, headers['Location']), (302, self.url))
+        self.assertEqual(self.get(static.SOUNDS_PATH + self.hash + '/b.ogg')[0], 404)
+
+
+class CursorsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cursors = paging.Cursors(first_page_size=2, page_size=3, ttl=60)
+        self.builds = 0
+
+    def build(self):
+        self.builds += 1
+        return range(7)
+
+    def test_pages(self):
+        pages = []
+        offset = ''
+        while True:
+            items, offset = self.cursors.page(self.cursors.get('key', self.build), offset)
+            pages.append(items)
+            if not offset:
+                break
+        self.assertEqual(pages, [[0, 1], [2, 3, 4], [5, 6]])
+        self.assertEqual((self.builds, self.cursors.hits), (1, 2))
+        self.assertEqual(self.cursors.page([0, 1, 2], 'not an offset'), ([0, 1], paging.encode_offset(2)))
+
+    def test_walk(self):
+        pages = []
+        offset = ''
+        while True:
+            items, offset = self.cursors.walk(list(range(9)), offset, skip={1, 2, 8}, head=1)
+            pages.append(items)
+            if not offset:
+                break
+        self.assertEqual(pages, [[0], [3, 4, 5], [6, 7]])
+
+    def test_search(self):
+        limits = []
+
+        def search(limit):
+            limits.append(limit)
+            return range(min(limit, 9))
+        pages = []
+        offset = ''
+        while True:
+            items, offset = self.cursors.search('key', search, offset)
+            pages.append(items)
+            if not offset:
+                break
+        self.assertEqual(pages, [[0, 1], [2, 3, 4], [5, 6, 7], [8]])
+        self.assertEqual(limits, [5, 8, 11])
+
+    def test_refresh_and_expiry(self):
+        self.cursors.get('key', self.build)
+        self.cursors.get('key', self.build, refresh=True)
+        self.assertEqual(self.builds, 2)
+        self.cursors.ttl = 0
+        self.cursors.get('other', self.build)
+        self.cursors.get('other', self.build)
+        self.assertEqual(self.builds, 4)
+
+
+SUPERVISED_WORKER = """
+import os
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logger
+import supervisor
+logger.set_logger('worker')
+worker = supervisor.Worker.from_environment()
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = str(os.getpid()).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+server = HTTPServer(worker.listen_socket.getsockname(), Handler, bind_and_activate=False)
+server.socket = worker.listen_socket
+worker.start(lambda message: worker.send(dict(message, pid=os.getpid(), snapshot=worker.snapshot())))
+server.serve_forever()
+"""
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def test_workers(self):
+        messages = queue.Queue()
+        pool = supervisor.Supervisor(2, '127.0.0.1', 0, lambda index, message: messages.put((index, message)),
+                                     command=[sys.executable, '-c', SUPERVISED_WORKER])
+        try:
+            pool.start({'sounds': 1})
+            self.assertEqual(os.stat(pool.snapshot_dir).st_mode & 0o777, 0o700)
+            pool.publish({'sounds': 2})
+            replies = [messages.get(timeout=10) for _ in range(2)]
+            self.assertEqual(sorted(index for index, message in replies), [0, 1])
+            self.assertEqual([message['snapshot'] for index, message in replies], [{'sounds': 2}] * 2)
+            pids = {message['pid'] for index, message in replies}
+            for _ in range(4):
+                with urllib.request.urlopen('http://127.0.0.1:{}/'.format(pool.port), timeout=10) as response:
+                    self.assertIn(int(response.read()), pids)
+            self.assertEqual(pool.alive(), 2)
+        finally:
+            pool.stop()
+        self.assertEqual(pool.alive(), 0)
+        self.assertFalse(os.path.exists(pool.snapshot_dir))
+
+
+class FileWatcherTest(unittest.TestCase):
+
+    def test_change_triggers_callback(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'data.json')
+            with open(path, 'w') as data_file:
+                data_file.write('{}')
+            changed = threading.Event()
+            watcher = FileWatcher(path, changed.set, interval=0.01).start()
+            self.assertFalse(changed.wait(0.05))
+            with open(path, 'w') as data_file:
+                data_file.write('{"sounds": []}')
+            self.assertTrue(changed.wait(1))
+            watcher.stop()
+
+
+class NormalizerTest(unittest.TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(normalizer.normalize('Multi-Kill!'), 'multi kill')
+        self.assertEqual(normalizer.normalize('  LUDICROUS\tkill  '), 'ludicrous kill')
+        self.assertEqual(normalizer.normalize('¡Cañón_héadshot!'), 'canon headshot')
+        self.assertEqual(normalizer.normalize('!!!'), '')
+
+    def test_tokenize(self):
+        self.assertEqual(normalizer.tokenize('double-kill'), ['double', 'kill'])
+        self.assertEqual(normalizer.tokenize('Dóuble kill', memoize=False), ['double', 'kill'])
+
+
+class SearchIndexTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sounds = [FakeSound(1, 'doublekill.ogg', 'Double kill', 'doublekill double kill'),
+                      FakeSound(2, 'killingspree.ogg', 'Killing spree', 'killingspree killing spree'),
+                      FakeSound(3, 'headshot.ogg', 'Headshot', 'headshot head shot'),
+                      FakeSound(4, 'multikill.ogg', 'Multi kill', 'multikill multi kill')]
+        cls.index = search.SearchIndex(cls.sounds)
+
+    def test_prefix_search(self):
+        self.assertEqual(self.index.search('head', 10), [self.sounds[2]])
+        self.assertEqual(self.index.search('HEADSH', 10), [self.sounds[2]])
+        self.assertEqual(self.index.search('nothing', 10), [])
+
+    def test_exact_matches_rank_first(self):
+        self.assertEqual(self.index.search('kill', 10), [self.sounds[0], self.sounds[3], self.sounds[1]])
+
+    def test_multiple_terms_are_and(self):
+        self.assertEqual(self.index.search('kill mult', 10), [self.sounds[3]])
+        self.assertEqual(self.index.search('kill head', 10), [])
+
+    def test_limit(self):
+        self.assertEqual(len(self.index.search('k', 2)), 2)
+        self.assertEqual(self.index.search('', 10), [])
+
+    def test_fuzzy_search(self):
+        index = search.SearchIndex(self.sounds, search.MODE_FUZZY)
+        self.assertEqual(index.search('dubble kil', 10), [self.sounds[0]])
+        self.assertEqual(index.search('hedshot', 10), [self.sounds[2]])
+        self.assertEqual(index.search('killling', 10), [self.sounds[1]])
+        self.assertEqual(index.search('xyzzy', 10), [])
+        self.assertEqual(self.index.search('hedshot', 10), [])
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_render(self):
+        registry = metrics.Registry()
+        requests = registry.counter('requests_total', 'Requests.', ['handler'])
+        seconds = registry.histogram('request_seconds', 'Request duration.', buckets=(0.1, 1))
+        registry.callback('queue_depth', 'Queued events.', lambda: 7)
+        requests.labels('query "text"').inc()
+        requests.labels('query "text"').inc(2)
+        for value in (0.05, 0.5, 5):
+            seconds.observe(value)
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{handler="query \\"text\\""} 3',
+            '# HELP request_seconds Request duration.',
+            '# TYPE request_seconds histogram',
+            'request_seconds_bucket{le="0.1"} 1',
+            'request_seconds_bucket{le="1"} 2',
+            'request_seconds_bucket{le="+Inf"} 3',
+            'request_seconds_sum 5.55',
+            'request_seconds_count 3',
+            '# HELP queue_depth Queued events.',
+            '# TYPE queue_depth gauge',
+            'queue_depth 7'])
+        with self.assertRaises(ValueError):
+            requests.labels()
+
+    def test_timed_and_http_server(self):
+        registry = metrics.Registry()
+        seconds = registry.histogram('call_seconds', 'Calls.', ['call'])
+        errors = registry.counter('call_errors_total', 'Failed calls.', ['call'])
+
+        @metrics.timed(seconds, 'fail', errors=errors)
+        def fail():
+            raise KeyError()
+
+        with self.assertRaises(KeyError):
+            fail()
+        self.assertEqual(sum(seconds.labels('fail').counts), 1)
+        self.assertEqual(errors.labels('fail').value, 1)
+
+        server = metrics.start_http_server(0, '127.0.0.1', registry=registry)
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+            with urllib.request.urlopen(url) as response:
+                body = response.read().decode()
+            self.assertIn('call_errors_total{call="fail"} 1', body)
+        finally:
+            server.shutdown()
+
+
+class LoggerTest(unittest.TestCase):
+
+    def test_queued_file_handler(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'bot.log')
+            handler = logger.add_file_handler(path, 'INFO')
+            try:
+                log = logger.get_logger('queued')
+                log.info('Written %s', 'later')
+                log.debug('Not written')
+            finally:
+                logger.get_logger().removeHandler(handler)
+                handler.close()
+            with open(path) as log_file:
+                lines = log_file.read().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith('INFO - Written later'))
+
+    def test_level_gating_and_sampling(self):
+        logger.set_log_level('INFO')
+        try:
+            self.assertFalse(logger.get_logger('gated').isEnabledFor(logging.DEBUG))
+        finally:
+            logger.set_log_level('DEBUG')
+        sampled = logger.get_sampled_logger('sampled', every=3)
+        records = []
+        sampled.addHandler(logging.Handler())
+        sampled.handlers[0].emit = records.append
+        try:
+            for i in range(7):
+                sampled.debug('Update %d', i)
+        finally:
+            sampled.handlers.clear()
+        self.assertEqual([record.getMessage() for record in records], ['Update 0', 'Update 3', 'Update 6'])
+
+
+class HandlersTest(unittest.TestCase):
+
+    def setUp(self):
+        registry = metrics.Registry()
+        self.handlers = Handlers(registry.histogram('handler_seconds', 'Handlers.', ['handler']),
+                                 registry.counter('handler_errors_total', 'Failed handlers.', ['handler']))
+        self.threads = []
+
+        @self.handlers.route('inline_handler', func=lambda query: query.query)
+        def query_text(inline_query):
+            return [reply('answer_inline_query', inline_query.id, [], cache_time=5)]
+
+        @self.handlers.route('inline_handler', blocking=True, func=lambda query: query.query == '')
+        def query_empty(inline_query):
+            self.threads.append(threading.current_thread().name)
+            return [reply('answer_inline_query', inline_query.id, [], is_personal=True)]
+
+    def updates(self):
+        user = {'id': 10, 'is_bot': False, 'first_name': 'first name'}
+        return [telebot.types.Update.de_json({'update_id': i, 'inline_query': {'id': str(i), 'from': user,
+                                                                                'query': text, 'offset': ''}})
+                for i, text in enumerate(('he', ''))]
+
+    def test_threaded_bot(self):
+        bot = telebot.TeleBot('1:token', threaded=False)
+        answers = []
+        bot.answer_inline_query = lambda query_id, results, **kwargs: answers.append((query_id, kwargs))
+        self.handlers.register(bot)
+        bot.process_new_updates(self.updates())
+        self.assertEqual(answers, [('0', {'cache_time': 5}), ('1', {'is_personal': True})])
+        self.assertEqual(sum(self.handlers.histogram.labels('query_text').counts), 1)
+
+    def test_async_runtime(self):
+        try:
+            from asyncbot import AsyncRuntime
+        except ImportError as e:
+            self.skipTest('AsyncTeleBot is not available: %s' % e)
+        runtime = AsyncRuntime('1:token', self.handlers, workers=2)
+        answers = []
+
+        async def answer_inline_query(query_id, results, **kwargs):
+            answers.append((query_id, kwargs))
+        runtime.bot.answer_inline_query = answer_inline_query
+
+        async def process():
+            await asyncio.gather(*(runtime.process(update) for update in self.updates()))
+            runtime.executor.shutdown()
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(process())
+        loop.close()
+        self.assertEqual(sorted(answers), [('0', {'cache_time': 5}), ('1', {'is_personal': True})])
+        self.assertTrue(self.threads[0].startswith('async-handlers'))
+
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()